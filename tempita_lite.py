@@ -32,15 +32,23 @@ License MIT, see license.txt.
 
 import re
 import sys
-import cgi
 import os
-import tokenize
-import inspect
-from copy import copy
-from pprint import pprint
+
+try:
+    from time import perf_counter as _timer
+except ImportError:
+    from time import time as _timer
+
+try:
+    import builtins as _builtins
+except ImportError:
+    import __builtin__ as _builtins
 
 __all__ = ['TemplateError', 'Template', 'sub', 'HTMLTemplate',
-           'sub_html', 'html', 'looper']
+           'sub_html', 'html', 'looper', 'TemplateLoader',
+           'precompile_directory', 'RenderMetrics', 'Sandbox',
+           'RenderLimits', 'TemplateLimitError', 'TemplateCache', 'lazy',
+           'compile_directory', 'CompiledLoader', 'AllocationProfiler']
 
 __version__ = "0.6.0dev"
 
@@ -85,13 +93,30 @@ class looper(object):
         for loop, item in looper(seq):
             if loop.first:
                 ...
+
+    With ``looper(seq).groupby(getter)`` the group boundaries are computed
+    in one pass before the loop, ``loop.first_group()`` and
+    ``loop.last_group()`` then look them up instead of comparing items.
     """
 
+    grouped = False
+    group = None
+
     def __init__(self, seq):
         self.seq = seq
 
+    def groupby(self, getter=None):
+        """
+        Loop over the same sequence grouped by getter (see
+        ``loop_pos.first_group`` for the kinds of getters).
+        """
+        grouped = self.__class__(self.seq)
+        grouped.grouped = True
+        grouped.group = getter
+        return grouped
+
     def __iter__(self):
-        return looper_iter(self.seq)
+        return looper_iter(self.seq, self.grouped, self.group)
 
     def __repr__(self):
         return '<%s for %r>' % (
@@ -100,9 +125,12 @@ class looper(object):
 
 class looper_iter(object):
 
-    def __init__(self, seq):
+    def __init__(self, seq, grouped=False, group=None):
         self.seq = list(seq)
         self.pos = 0
+        self.groups = None
+        if grouped:
+            self.groups = _loop_groups(self.seq, group)
 
     def __iter__(self):
         return self
@@ -110,7 +138,8 @@ class looper_iter(object):
     def __next__(self):
         if self.pos >= len(self.seq):
             raise StopIteration
-        result = loop_pos(self.seq, self.pos), self.seq[self.pos]
+        result = (loop_pos(self.seq, self.pos, self.groups),
+                  self.seq[self.pos])
         self.pos += 1
         return result
 
@@ -118,11 +147,56 @@ class looper_iter(object):
         next = __next__
 
 
+class _loop_groups(object):
+    """
+    The group boundaries of a sequence: ``first[i]`` / ``last[i]`` tell if
+    item i starts / ends a group.
+    """
+
+    def __init__(self, seq, getter):
+        self.getter = getter
+        keys = list(map(_group_key(getter), seq))
+        changed = [keys[i] != keys[i + 1] for i in range(len(keys) - 1)]
+        self.first = [True] + changed
+        self.last = changed + [True]
+
+
+_group_keys = {}
+
+
+def _group_key(getter):
+    """
+    Return a function of an item giving the value that getter groups by.
+    """
+    try:
+        return _group_keys[getter]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable, used as an index
+        return lambda item: item[getter]
+    from operator import attrgetter, itemgetter
+    if getter is None:
+        key = lambda item: item
+    elif isinstance(getter, basestring_) and getter.startswith('.'):
+        if getter.endswith('()'):
+            key = lambda item, get=attrgetter(getter[1:-2]): get(item)()
+        else:
+            key = attrgetter(getter[1:])
+    elif hasattr(getter, '__call__'):
+        return getter
+    else:
+        key = itemgetter(getter)
+    _group_keys[getter] = key
+    return key
+
+
 class loop_pos(object):
 
-    def __init__(self, seq, pos):
+    def __init__(self, seq, pos, groups=None):
         self.seq = seq
         self.pos = pos
+        self.groups = groups
 
     def __repr__(self):
         return '<loop pos=%r at %r>' % (
@@ -181,8 +255,13 @@ class loop_pos(object):
         Returns true if this item is the start of a new group,
         where groups mean that some attribute has changed.  The getter
         can be None (the item itself changes), an attribute name like
-        ``'.attr'``, a function, or a dict key or list index.
+        ``'.attr'``, a function, or a dict key or list index.  In a
+        ``looper.groupby()`` loop the getter defaults to the one grouped by.
         """
+        groups = self.groups
+        if groups is not None and (getter is None
+                                   or getter == groups.getter):
+            return groups.first[self.pos]
         if self.first:
             return True
         return self._compare_group(self.item, self.previous, getter)
@@ -192,27 +271,20 @@ class loop_pos(object):
         Returns true if this item is the end of a new group,
         where groups mean that some attribute has changed.  The getter
         can be None (the item itself changes), an attribute name like
-        ``'.attr'``, a function, or a dict key or list index.
+        ``'.attr'``, a function, or a dict key or list index.  In a
+        ``looper.groupby()`` loop the getter defaults to the one grouped by.
         """
+        groups = self.groups
+        if groups is not None and (getter is None
+                                   or getter == groups.getter):
+            return groups.last[self.pos]
         if self.last:
             return True
         return self._compare_group(self.item, self.__next__, getter)
 
     def _compare_group(self, item, other, getter):
-        if getter is None:
-            return item != other
-        elif (isinstance(getter, basestring_)
-              and getter.startswith('.')):
-            getter = getter[1:]
-            if getter.endswith('()'):
-                getter = getter[:-2]
-                return getattr(item, getter)() != getattr(other, getter)()
-            else:
-                return getattr(item, getter) != getattr(other, getter)
-        elif hasattr(getter, '__call__'):
-            return getter(item) != getter(other)
-        else:
-            return item[getter] != other[getter]
+        key = _group_key(getter)
+        return key(item) != key(other)
 
 #
 # end _looper.py
@@ -238,6 +310,107 @@ class TemplateError(Exception):
         return msg
 
 
+class TemplateLimitError(TemplateError):
+    """Exception raised when a render exceeds one of its ``RenderLimits``
+    """
+
+
+class RenderLimits(object):
+    """
+    Budgets of a single render.
+
+    :param int output: Maximum number of characters of output.
+    :param int iterations: Maximum number of ``{{for}}`` loop iterations,
+                           all loops together.
+    :param float seconds: Maximum time a render may take, checked at every
+                          loop iteration.
+    """
+
+    def __init__(self, output=None, iterations=None, seconds=None):
+        self.output = output
+        self.iterations = iterations
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '<%s output=%r iterations=%r seconds=%r>' % (
+            self.__class__.__name__, self.output, self.iterations,
+            self.seconds)
+
+
+class _RenderBudget(object):
+    """
+    What is left of the ``RenderLimits`` during one render.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.size = 0
+        self.iterations = 0
+        self.deadline = None
+        if limits.seconds is not None:
+            self.deadline = _timer() + limits.seconds
+
+    def counting(self, append):
+        """
+        Wrap the append method of an output list to count its size.
+        """
+        if self.limits.output is None:
+            return append
+        limit = self.limits.output
+
+        def counting_append(value):
+            self.size += len(value)
+            if self.size > limit:
+                raise TemplateLimitError(
+                    'Output longer than %i characters' % limit, None)
+            append(value)
+        return counting_append
+
+    def check(self):
+        """
+        Count a loop iteration and check the deadline.
+        """
+        self.iterations += 1
+        limit = self.limits.iterations
+        if limit is not None and self.iterations > limit:
+            raise TemplateLimitError(
+                'More than %i loop iterations' % limit, None)
+        if self.deadline is not None and _timer() > self.deadline:
+            raise TemplateLimitError(
+                'Render took longer than %s seconds' % self.limits.seconds,
+                None)
+
+    def iterate(self, iterable):
+        check = self.check
+        for item in iterable:
+            check()
+            yield item
+
+
+class _BudgetList(list):
+    """
+    An output list carrying the ``_RenderBudget`` of the render.
+    """
+
+    def __init__(self, budget, counted=True):
+        list.__init__(self)
+        self.budget = budget
+        if counted:
+            self.append = budget.counting(list.append.__get__(self))
+
+
+def _bind_loop_vars(vars, item, ns):
+    if len(vars) == 1:
+        ns[vars[0]] = item
+    else:
+        if len(vars) != len(item):
+            raise ValueError(
+                'Need %i items to unpack (got %i items)'
+                % (len(vars), len(item)))
+        for name, value in zip(vars, item):
+            ns[name] = value
+
+
 class _TemplateContinue(Exception):
     pass
 
@@ -246,11 +419,683 @@ class _TemplateBreak(Exception):
     pass
 
 
+class RenderMetrics(object):
+    """
+    Metrics sink collecting counts, timings, output sizes and errors per
+    event and template name.
+
+    Any object with a ``record`` method like the one of this class can be
+    used as the ``metrics`` of templates and loaders, to forward the
+    events to another metrics system.  The events are ``parse`` (at
+    construction), ``compile``, ``render`` (``substitute`` and
+    ``render_to``), ``render_def``, ``inherit`` (rendering the parent
+    template) and ``cache_hit``/``cache_miss`` of a ``TemplateLoader``.
+    """
+
+    def __init__(self):
+        # (event, name) -> [count, errors, seconds, max seconds, size]
+        self.data = {}
+
+    def __repr__(self):
+        return '<%s (%i entries)>' % (self.__class__.__name__, len(self.data))
+
+    def record(self, event, name, seconds, size=None, error=None):
+        """
+        Record an event of a template that took seconds, size is the
+        length of the output and error the exception raised if any.
+        """
+        entry = self.data.get((event, name))
+        if entry is None:
+            entry = self.data[(event, name)] = [0, 0, 0.0, 0.0, 0]
+        entry[0] += 1
+        if error is not None:
+            entry[1] += 1
+        entry[2] += seconds
+        if seconds > entry[3]:
+            entry[3] = seconds
+        if size:
+            entry[4] += size
+
+    def stats(self, event='render'):
+        """
+        Return a dict of template name to a dict with ``count``,
+        ``errors``, ``seconds``, ``max`` and ``size`` for one event.
+        """
+        return dict(
+            (name, dict(zip(('count', 'errors', 'seconds', 'max', 'size'),
+                            entry)))
+            for (kind, name), entry in self.data.items() if kind == event)
+
+    def slowest(self, count=10, event='render'):
+        """
+        Return the names and total seconds of the templates the most time
+        was spent in.
+        """
+        totals = [(entry[2], name)
+                  for (kind, name), entry in self.data.items()
+                  if kind == event]
+        totals.sort(reverse=True)
+        return [(name, seconds) for seconds, name in totals[:count]]
+
+    def clear(self):
+        self.data.clear()
+
+
+class AllocationProfiler(object):
+    """
+    Profile the memory allocated by renders with ``tracemalloc``, used as
+    the ``profiler`` of templates and loaders (while it is set every
+    render is slowed down a lot).
+
+    Each render is wrapped with tracemalloc snapshots, the second one is
+    taken when the output parts are complete (before they are joined),
+    so they and the namespace of the render are still allocated.  The
+    difference is attributed to the template and node position whose
+    compiled code allocated it (the position is None for interpreted
+    renders and allocations outside of template code).  The peak of the
+    traced memory during a render is kept per template.  Renders of
+    inherited templates and defs count for the render they are part of.
+
+    :param int frames: Number of frames tracemalloc stores per
+                       allocation, enough to reach the template code from
+                       the functions it calls.
+    """
+
+    def __init__(self, frames=30):
+        self.frames = frames
+        # name -> [renders, max peak, allocated size]
+        self.templates = {}
+        # (name, pos) -> [size, count]
+        self.sites = {}
+        # code filename -> (name, line positions) of compiled templates
+        self.code_positions = {}
+        self.depth = 0
+        self.snapshot = None
+        self.peak = 0
+        self.overhead = 0
+
+    def __repr__(self):
+        return '<%s (%i templates)>' % (
+            self.__class__.__name__, len(self.templates))
+
+    def profile(self, template, func, *args):
+        """
+        Call func (a render of template) and record its allocations.
+        """
+        import tracemalloc
+        self.register(template)
+        if self.depth:
+            return func(*args)
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(self.frames)
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        self.depth += 1
+        try:
+            before = tracemalloc.take_snapshot()
+            base = tracemalloc.get_traced_memory()[0]
+            if reset_peak is not None:
+                reset_peak()
+            self.peak = self.overhead = 0
+            result = func(*args)
+            # without the memory of the checkpoint snapshot
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1]
+                       - self.overhead) - base
+            after = self.snapshot or tracemalloc.take_snapshot()
+        finally:
+            self.depth -= 1
+            self.snapshot = None
+            if started:
+                tracemalloc.stop()
+        if reset_peak is None and not started:
+            # the peak of an earlier part of the tracing
+            peak = None
+        own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        self.record(template.name, peak, after.filter_traces(own).compare_to(
+            before.filter_traces(own), 'traceback'))
+        return result
+
+    def checkpoint(self, template):
+        """
+        Take the snapshot of the allocations of the render being profiled,
+        called by template when its output parts are complete.
+        """
+        if not self.depth:
+            return
+        import tracemalloc
+        # compiled by this render
+        self.register(template)
+        self.snapshot = None
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        self.snapshot = tracemalloc.take_snapshot()
+        self.overhead = tracemalloc.get_traced_memory()[0] - current
+
+    def register(self, template):
+        """
+        Make the compiled code of a template known, to find the node
+        positions of its allocations.
+        """
+        render = template._render_func
+        if callable(render):
+            info = render.__globals__.get('__tempita_template__')
+            if info is not None:
+                self.code_positions[render.__code__.co_filename] = info
+
+    def record(self, name, peak, differences):
+        """
+        Record a render of the template name with its peak memory and the
+        ``tracemalloc.StatisticDiff`` list of its allocations.
+        """
+        entry = self.templates.get(name)
+        if entry is None:
+            entry = self.templates[name] = [0, 0, 0]
+        entry[0] += 1
+        if peak is not None and peak > entry[1]:
+            entry[1] = peak
+        for difference in differences:
+            if difference.size_diff <= 0:
+                continue
+            site = self.site(difference.traceback, name)
+            allocated = self.sites.get(site)
+            if allocated is None:
+                allocated = self.sites[site] = [0, 0]
+            allocated[0] += difference.size_diff
+            allocated[1] += difference.count_diff
+            entry[2] += difference.size_diff
+
+    def site(self, traceback, name):
+        """
+        Return the template name and position of the innermost compiled
+        template frame of a traceback, or (name, None).
+        """
+        for frame in reversed(traceback):
+            info = self.code_positions.get(frame.filename)
+            if info is not None:
+                pos = info[1].get(frame.lineno)
+                if pos is not None:
+                    return info[0], pos
+        return name, None
+
+    def stats(self):
+        """
+        Return a dict of template name to a dict with ``renders``,
+        ``peak`` (the largest peak of a render in bytes) and ``size``
+        (bytes still allocated after the renders).
+        """
+        return dict(
+            (name, dict(zip(('renders', 'peak', 'size'), entry)))
+            for name, entry in self.templates.items())
+
+    def top(self, count=10):
+        """
+        Return the ``((name, pos), size, count)`` of the template nodes
+        that allocated the most.
+        """
+        sites = sorted(self.sites.items(), key=lambda item: -item[1][0])
+        return [(site, size, number)
+                for site, (size, number) in sites[:count]]
+
+    def clear(self):
+        self.templates.clear()
+        self.sites.clear()
+
+
+def _read_source(filename, encoding):
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if encoding:
+        content = content.decode(encoding)
+    return content
+
+
+def _map_literals(codes, func):
+    """
+    Replace every literal string of a parse tree (in place) with
+    func(string).
+    """
+    for index, code in enumerate(codes):
+        if isinstance(code, unicode):
+            codes[index] = func(code)
+        elif isinstance(code, Node):
+            if code[0] in ('for', 'def'):
+                _map_literals(code[4], func)
+            elif code[0] == 'cond':
+                for part in code[2:]:
+                    _map_literals(part[3], func)
+
+
+def _intern_literals(codes, table):
+    """
+    Replace the literal strings of a parse tree (in place) with the equal
+    strings in table, adding the new ones.
+    """
+    _map_literals(codes, lambda text: table.setdefault(text, text))
+
+
+def _compact_literals(trees, encoding='utf8'):
+    """
+    Move the literal strings of parse trees into one buffer, they are
+    replaced with ``MappedText`` slices of it.
+    """
+    texts = {}
+    for codes in trees:
+        _map_literals(codes, lambda text: texts.setdefault(text, text))
+    parts = []
+    offsets = {}
+    start = 0
+    for text in texts:
+        data = text.encode(encoding)
+        parts.append(data)
+        offsets[text] = start, start + len(data)
+        start += len(data)
+    buffer = b''.join(parts)
+    mapped = dict((text, MappedText(buffer, offsets[text][0],
+                                    offsets[text][1], encoding))
+                  for text in texts)
+    for codes in trees:
+        _map_literals(codes, mapped.__getitem__)
+    return buffer
+
+
+def _intern_code(code, table):
+    """
+    Return code with its string constants (and the ones of the nested
+    functions) replaced by the equal strings in table.
+    """
+    if not hasattr(code, 'replace'):
+        # Python < 3.8
+        return code
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, unicode):
+            const = table.setdefault(const, const)
+        elif isinstance(const, type(code)):
+            const = _intern_code(const, table)
+        consts.append(const)
+    return code.replace(co_consts=tuple(consts))
+
+
 def get_file_template(name, from_template):
     path = os.path.join(os.path.dirname(from_template.name), name)
     return from_template.__class__.from_filename(
         path, namespace=from_template.namespace,
-        get_template=from_template.get_template)
+        get_template=from_template.get_template,
+        sandbox=from_template.sandbox)
+
+
+class TemplateLoader(object):
+    """
+    Load templates from files below a directory and keep them parsed.
+
+    A loader is a ``get_template`` function: inherited templates are
+    resolved relative to the inheriting template and loaded through the
+    same cache.
+
+    :param str directory: Directory template names are relative to.
+    :param template_class: Class used for the templates.
+    :param dict namespace: Namespace passed to every template.
+    :param str encoding: Encoding of the template files.
+    :param bool share_literals: Use one string object for equal literal
+                                text of all templates (and their compiled
+                                code), e.g. copied headers and footers.
+    :param options: Other keyword arguments for the template class, a
+                    ``metrics`` sink also gets the cache hits and misses.
+                    With ``keep_source=False`` the template sources are
+                    not kept in memory.
+    """
+
+    def __init__(self, directory, template_class=None, namespace=None,
+                 encoding='utf8', share_literals=False, **options):
+        self.directory = directory
+        self.template_class = template_class or Template
+        self.namespace = namespace
+        self.encoding = encoding
+        self.options = options
+        self.metrics = options.get('metrics')
+        self.templates = {}
+        # the shared literal strings
+        self.literals = {} if share_literals else None
+        # set collecting the paths of the used templates while not None
+        self.track = None
+
+    def __repr__(self):
+        return '<%s %r (%i templates)>' % (
+            self.__class__.__name__, self.directory, len(self.templates))
+
+    def __call__(self, name, from_template):
+        return self.load_path(
+            os.path.join(os.path.dirname(from_template.name), name))
+
+    def load(self, name):
+        """
+        Return the template with the name relative to the directory.
+        """
+        return self.load_path(os.path.join(self.directory, name))
+
+    def load_path(self, path):
+        path = os.path.normpath(path)
+        if self.track is not None:
+            self.track.add(path)
+        template = self.templates.get(path)
+        if template is None:
+            start = _timer()
+            template = self.template_class.from_filename(
+                path, namespace=self.namespace, encoding=self.encoding,
+                get_template=self, **self.options)
+            self._share_literals(template)
+            self.templates[path] = template
+            if self.metrics is not None:
+                self.metrics.record('cache_miss', path, _timer() - start)
+        elif self.metrics is not None:
+            self.metrics.record('cache_hit', path, 0.0)
+        return template
+
+    def invalidate(self, path):
+        """
+        Drop the template of a changed file, it is loaded again on use.
+        """
+        self.templates.pop(os.path.normpath(path), None)
+
+    def add(self, path, content, parsed, code=None):
+        """
+        Add a template parsed elsewhere (see ``precompile_directory``),
+        code is its marshaled compiled render code and line positions.
+        """
+        path = os.path.normpath(path)
+        template = self.template_class(
+            content, name=path, namespace=self.namespace,
+            get_template=self, parsed=parsed, **self.options)
+        template._source = path, self.encoding
+        self._share_literals(template)
+        if code is not None:
+            import marshal
+            template._render_func = template._load_code(
+                marshal.loads(code[0]), code[1])
+        self.templates[path] = template
+        return template
+
+    def preload(self, pattern='*'):
+        """
+        Load and compile all templates below the directory matching
+        pattern, e.g. in the master of a pre-fork server before the
+        workers are started (see ``freeze``).  Return the number of
+        templates loaded.
+        """
+        filenames = _template_files(self.directory, pattern)
+        for filename in filenames:
+            self._compiled(self.load_path(filename))
+        return len(filenames)
+
+    def freeze(self, compact=False):
+        """
+        Prepare the loaded templates to be shared by forked processes.
+        The garbage collector leaves the objects existing now alone
+        (``gc.freeze``, Python 3.7+), so collections in the workers do
+        not write to their memory pages.
+
+        With compact the literal text of all templates is moved into one
+        buffer, appending it to the output of a render then only changes
+        the reference count of the buffer instead of a page of every
+        string.  Rendering decodes the text of the buffer every time.
+        """
+        import gc
+        if compact:
+            templates = list(self.templates.values())
+            _compact_literals([template._parsed for template in templates])
+            for template in templates:
+                if callable(template._render_func):
+                    # the compiled code holds the strings
+                    template._render_func = None
+                    self._compiled(template)
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    def _compiled(self, template):
+        if template.use_compiled and (
+                template._render_func is None
+                or template._render_func is _compile_pending):
+            template._render_func = template._measured(
+                'compile', template._compile)
+        return template
+
+    def _share_literals(self, template):
+        if self.literals is not None:
+            _intern_literals(template._parsed, self.literals)
+            template._literal_table = self.literals
+
+
+def precompile_directory(path, workers=None, pattern='*', loader=None,
+                         **options):
+    """
+    Parse and compile all templates below a directory in a process pool
+    and return a ``TemplateLoader`` holding them.
+
+    :param str path: Directory to scan recursively, hidden files and
+                     directories are skipped.
+    :param int workers: Number of worker processes, by default the number
+                        of CPUs; with one worker everything is done in
+                        this process.
+    :param str pattern: Shell pattern file names have to match.
+    :param loader: Loader to fill, by default a new ``TemplateLoader``
+                   created with path and options.
+    """
+    if loader is None:
+        loader = TemplateLoader(path, **options)
+    filenames = _template_files(path, pattern)
+    # metrics and profiles are recorded in this process only
+    options = dict(loader.options)
+    options.pop('metrics', None)
+    options.pop('profiler', None)
+    tasks = [(loader.template_class, filename, loader.encoding, options)
+             for filename in filenames]
+    if workers is None:
+        workers = hasattr(os, 'cpu_count') and os.cpu_count() or 1
+    if workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                _precompile_file, tasks,
+                chunksize=len(tasks) // (workers * 4) + 1))
+    else:
+        results = map(_precompile_file, tasks)
+    for filename, content, parsed, code in results:
+        loader.add(filename, content, parsed, code)
+    return loader
+
+
+def _precompile_file(task):
+    template_class, filename, encoding, options = task
+    template = template_class.from_filename(
+        filename, encoding=encoding, **options)
+    code = template._compile_code()
+    if code is not None:
+        import marshal
+        code = marshal.dumps(code[0]), code[1]
+    return filename, template.content, template._parsed, code
+
+
+def _template_files(path, pattern):
+    """
+    The files below path matching pattern, hidden files and directories
+    are skipped.
+    """
+    import fnmatch
+    filenames = []
+    for dirpath, dirnames, names in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in sorted(names):
+            if not name.startswith('.') and fnmatch.fnmatch(name, pattern):
+                filenames.append(os.path.join(dirpath, name))
+    return filenames
+
+
+class CompiledLoader(object):
+    """
+    The ``get_template`` function of a package written by
+    ``compile_directory``, it imports the module of a template on first
+    use.
+
+    :param str package: Name of the generated package.
+    :param dict modules: Maps template names (paths relative to the
+                         compiled directory) to module names.
+    :param template_class: Class used for the templates.
+    :param dict namespace: Namespace passed to every template.
+    """
+
+    def __init__(self, package, modules, template_class=None,
+                 namespace=None):
+        self.package = package
+        self.modules = modules
+        self.template_class = template_class or Template
+        self.namespace = namespace
+
+    def __repr__(self):
+        return '<%s %r (%i templates)>' % (
+            self.__class__.__name__, self.package, len(self.modules))
+
+    def __call__(self, name, from_template):
+        import posixpath
+        return self.load(posixpath.normpath(posixpath.join(
+            posixpath.dirname(from_template.name), name)))
+
+    def load(self, name):
+        """
+        Return the template with the name relative to the compiled
+        directory.
+        """
+        import importlib
+        module = self.modules.get(name)
+        if module is None:
+            raise TemplateError('No compiled template %r in %s'
+                                % (name, self.package),
+                                position=None, name=None)
+        return importlib.import_module('.' + module, self.package).template
+
+    def template(self, name, render, parsed):
+        """
+        Create the template of a generated module from its render function
+        (None if the template could not be compiled) and parse tree.
+        """
+        template = self.template_class(
+            u'', name=name, namespace=self.namespace, get_template=self,
+            parsed=[_node_from_tuple(code) for code in parsed])
+        # not compiled again when rendered
+        template._render_func = render if render is not None else False
+        return template
+
+
+def compile_directory(path, output, pattern='*', template_class=None,
+                      encoding='utf8'):
+    """
+    Compile all templates below a directory into a Python package: every
+    template becomes a module with the compiled render function, its
+    ``template`` and ``render(**ns)``.  The package has a ``loader``
+    (a ``CompiledLoader``) and ``render(template_name, **ns)``.  Importing the
+    package does not lex or parse any template.
+
+    :param str path: Directory to scan recursively, hidden files and
+                     directories are skipped.
+    :param str output: Directory of the package, its name is the package
+                       name.
+    :param str pattern: Shell pattern file names have to match.
+    :param template_class: Class used for the templates, the package
+                           imports it from its module.
+    :return: A dict mapping template names to module names.
+    """
+    template_class = template_class or Template
+    class_module = template_class.__module__
+    if class_module == __name__:
+        # run as a script
+        class_module = 'tempita_lite'
+    if (class_module == '__main__' or '.' in getattr(
+            template_class, '__qualname__', template_class.__name__)):
+        raise ValueError('Template class %r cannot be imported by the '
+                         'compiled package' % template_class)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    modules = {}
+    for filename in _template_files(path, pattern):
+        name = os.path.relpath(filename, path).replace(os.sep, '/')
+        module = _compiled_module_name(name)
+        if module in modules.values():
+            raise ValueError('Templates %r and %r have the same module name'
+                             % (name, [other for other in modules
+                                       if modules[other] == module][0]))
+        modules[name] = module
+        template = template_class.from_filename(filename, encoding=encoding)
+        _write_output(os.path.join(output, module + '.py'),
+                      _compiled_module(template, name), 'utf8')
+    _write_output(os.path.join(output, '__init__.py'), _compiled_package % {
+        'class': template_class.__name__,
+        'class_module': class_module,
+        'modules': ''.join('    %r: %r,\n' % item
+                           for item in sorted(modules.items()))}, 'utf8')
+    return modules
+
+
+def _compiled_module_name(name):
+    module = re.sub(r'\W', '_', name)
+    if module[:1].isdigit() or module == '__init__':
+        module = 't_' + module
+    return module
+
+
+_compiled_package = """\
+# -*- coding: utf-8 -*-
+# Templates compiled by tempita_lite, do not edit.
+from tempita_lite import CompiledLoader
+from %(class_module)s import %(class)s
+
+loader = CompiledLoader(__name__, {
+%(modules)s}, %(class)s)
+
+
+def render(template_name, **ns):
+    return loader.load(template_name).substitute(ns)
+"""
+
+
+def _compiled_module(template, name):
+    try:
+        source, positions = TemplateCompiler(template).compile()
+    except _CompileError:
+        # interpreted when rendered
+        source, positions = None, {}
+    head = [
+        '# -*- coding: utf-8 -*-',
+        '# Template %r compiled by tempita_lite, do not edit.' % name,
+        'from tempita_lite import CompiledTemplateDef as _t_CompiledDef',
+        'from . import loader as _t_loader',
+        '',
+    ]
+    lines = head + [None, '', '']
+    # positions are kept by the line numbers of the render function, which
+    # starts after all lines so far
+    offset = len(lines)
+    lines[len(head)] = '__tempita_template__ = (%r, %r)' % (name, dict(
+        (line + offset, pos) for line, pos in positions.items()
+        if pos is not None))
+    if source is None:
+        lines.append('_t_render = None')
+    else:
+        lines.append(source)
+    lines += [
+        '',
+        'template = _t_loader.template(%r, _t_render, [' % name,
+        '    %s])' % ',\n    '.join(
+            repr(_plain_node(code)) for code in template._parsed),
+        '',
+        '',
+        'def render(**ns):',
+        '    return template.substitute(ns)',
+        '']
+    return '\n'.join(lines)
+
+
+# _render_func of a template rendered once, compiled by the next render
+_compile_pending = object()
 
 
 class Template(object):
@@ -270,6 +1115,22 @@ class Template(object):
     :param int line_offset: If the template is embedded and does not start with
                         line 1 a line offset can be specified.
     :param tuple delimiters: A tuple of the delimiters used in template content.
+    :param bool strict: Check the namespace for all names the template needs
+                        before rendering (see ``required_names``).
+    :param list parsed: The already parsed content (as returned by ``parse``),
+                        content is not parsed again if given.
+    :param metrics: A sink like ``RenderMetrics`` getting the timings of
+                    parsing, compiling and rendering the template.
+    :param sandbox: A ``Sandbox`` to check and evaluate the expressions
+                    with, for templates that cannot be trusted.
+    :param limits: ``RenderLimits`` for every render of the template, a
+                   ``TemplateLimitError`` is raised when one is exceeded.
+    :param bool keep_source: With False the content is dropped once it is
+                             parsed, ``content`` reads it again from the
+                             file of a template loaded with
+                             ``from_filename`` (and is None otherwise).
+    :param profiler: An ``AllocationProfiler`` recording the memory
+                     allocated by the renders.
     :return: A new template object.
     """
 
@@ -282,11 +1143,34 @@ class Template(object):
     default_encoding = 'utf8'
     default_inherit = None
     default_filter = None
+    strict = False
+    use_compiled = True
+    metrics = None
+    sandbox = None
+    limits = None
+    profiler = None
+    keep_source = True
+    _mapped_literals = ()
+    # (filename, encoding) to read a dropped content again
+    _source = None
+    # dict of the shared literal strings, see TemplateLoader
+    _literal_table = None
 
     def __init__(self, content, name=None, namespace=None, stacklevel=None,
                  get_template=None, default_inherit=None, line_offset=0,
-                 delimeters=None):
+                 delimeters=None, strict=None, parsed=None, metrics=None,
+                 sandbox=None, limits=None, keep_source=None, profiler=None):
         self.content = content
+        if profiler is not None:
+            self.profiler = profiler
+        if keep_source is not None:
+            self.keep_source = keep_source
+        if metrics is not None:
+            self.metrics = metrics
+        if sandbox is not None:
+            self.sandbox = sandbox
+        if limits is not None:
+            self.limits = limits
 
         # set delimeters
         if delimeters is None:
@@ -302,7 +1186,10 @@ class Template(object):
         self.delimeters = delimeters
 
         #self._unicode = is_unicode(content)
-        self._unicode = isinstance(content, unicode)
+        if isinstance(content, MappedText):
+            self._unicode = content.encoding is not None
+        else:
+            self._unicode = isinstance(content, unicode)
         if name is None and stacklevel is not None:
             try:
                 caller = sys._getframe(stacklevel)
@@ -322,25 +1209,104 @@ class Template(object):
                 if lineno:
                     name += ':%s' % lineno
         self.name = name
-        self._parsed = parse(
-            content, name=name, line_offset=line_offset,
-            delimeters=self.delimeters)
+        if parsed is None:
+            parsed = self._measured(
+                'parse', parse, content, name, line_offset, self.delimeters)
+        self._parsed = parsed
+        if not self.keep_source and not isinstance(content, MappedText):
+            # mapped content is not a copy of the file
+            self._content = None
         if namespace is None:
             namespace = {}
         self.namespace = namespace
+        if self.sandbox is not None:
+            self._safe_exprs = self._compile_sandboxed(parsed, {})
         self.get_template = get_template
         if default_inherit is not None:
             self.default_inherit = default_inherit
+        if strict is not None:
+            self.strict = strict
+        self._names = None
+        self._required = None
+        self._defs = None
+        self._expr_code = {}
+        self._render_func = None
+        self._global_ns = None
+        self._column_specs = {}
 
     @classmethod
     def from_filename(cls, filename, namespace=None, encoding=None,
-                      default_inherit=None, get_template=get_file_template):
-        with open(filename, 'rb') as f:
-            c = f.read()
-        if encoding:
-            c = c.decode(encoding)
-        return cls(content=c, name=filename, namespace=namespace,
-                   default_inherit=default_inherit, get_template=get_template)
+                      default_inherit=None, get_template=get_file_template,
+                      mapped=False, **kw):
+        """
+        Load a template from a file.  With ``mapped`` the file is memory
+        mapped and lexed in place, literal text stays a reference into the
+        mapping (see ``MappedText``) until it is rendered.
+        """
+        if mapped:
+            if not encoding and unicode is str:
+                # there are no byte templates on Python 3
+                encoding = cls.default_encoding
+            # lexed in place when the template is created
+            c = map_file(filename, encoding)
+        if not mapped or c is None:
+            c = _read_source(filename, encoding)
+        template = cls(content=c, name=filename, namespace=namespace,
+                       default_inherit=default_inherit,
+                       get_template=get_template, **kw)
+        template._source = filename, encoding
+        return template
+
+    @property
+    def content(self):
+        """
+        The template source, read from the file again if it was not kept
+        (see ``keep_source``).
+        """
+        if self._content is None and self._source is not None:
+            return _read_source(*self._source)
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+    def _analyze_names(self):
+        if self._names is None:
+            self._names = analyze_names(self._parsed)
+        return self._names
+
+    @property
+    def required_names(self):
+        """
+        Names the template reads from the namespace before (or without)
+        binding them itself.  Names of the default namespace, builtins and
+        the template ``namespace`` are not included.
+        """
+        if self._required is None:
+            required, bound = self._analyze_names()
+            provided = self.namespace
+            self._required = frozenset(
+                name for name in required
+                if name not in provided
+                and name not in self.default_namespace
+                and name != '__template_name__'
+                and not hasattr(_builtins, name))
+        return self._required
+
+    @property
+    def bound_names(self):
+        """
+        Names bound by the template itself: ``for`` targets, ``default``
+        variables and ``def`` blocks.
+        """
+        return self._analyze_names()[1]
+
+    def missing_names(self, ns):
+        """
+        Return a sorted list of the ``required_names`` not present in ns.
+        """
+        return sorted(name for name in self.required_names if name not in ns)
 
     def __repr__(self):
         return '<%s %s name=%r>' % (
@@ -352,6 +1318,94 @@ class Template(object):
         Substitute the template with the specified arguments.
         If one positional argument is given this is interpreted as a dict.
         """
+        if self.profiler is not None:
+            return self.profiler.profile(self, self._measured, 'render',
+                                         self._substitute, args, kw)
+        if self.metrics is not None:
+            return self._measured('render', self._substitute, args, kw)
+        return self._substitute(args, kw)
+
+    def _substitute(self, args, kw):
+        ns = self._namespace(args, kw)
+        render = self._render_func
+        if render is None and self.use_compiled:
+            # the first render is interpreted, later ones use compiled code
+            self._render_func = _compile_pending
+        elif render is _compile_pending:
+            render = self._render_func = self._measured(
+                'compile', self._compile)
+        if render and type(ns) is not _LazyNamespace:
+            # compiled code loads every name up front, lazy values are
+            # only resolved when read by the interpreter
+            result, defs, inherit = self._interpret_compiled(render, ns)
+        else:
+            result, defs, inherit = self._interpret(ns)
+        if not inherit:
+            inherit = self.default_inherit
+        if inherit:
+            result = self._measured('inherit', self._interpret_inherit,
+                                    result, defs, inherit, ns)
+        return result
+
+    def _measured(self, event, func, *args):
+        """
+        Call func and report the time it took to the metrics sink.
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return func(*args)
+        start = _timer()
+        try:
+            result = func(*args)
+        except Exception as e:
+            metrics.record(event, self.name, _timer() - start, error=e)
+            raise
+        size = len(result) if isinstance(result, basestring_) else None
+        metrics.record(event, self.name, _timer() - start, size=size)
+        return result
+
+    def render_to(self, fileobj, *args, **kw):
+        """
+        Substitute the template like ``substitute`` and write the result
+        to a file object.  The output is written while rendering.  Binary
+        files get the output encoded with the template encoding, literal
+        text of memory mapped templates is then written straight from the
+        mapping.  Templates using inheritance are substituted first.
+        """
+        if self.profiler is not None:
+            self.profiler.profile(self, self._measured, 'render',
+                                  self._render_to, fileobj, args, kw)
+        elif self.metrics is not None:
+            self._measured('render', self._render_to, fileobj, args, kw)
+        else:
+            self._render_to(fileobj, args, kw)
+
+    def _render_to(self, fileobj, args, kw):
+        import io
+        ns = self._namespace(args, kw)
+        encoding = None
+        if not isinstance(fileobj, io.TextIOBase) and unicode is str:
+            encoding = (getattr(self._content, 'encoding', None)
+                        or self.default_encoding)
+        sink = _FileSink(fileobj, encoding)
+        if self.default_inherit or self._has_inherit():
+            sink.append(self._substitute((ns,), {}))
+            return
+        if self.limits is not None:
+            sink.budget = self._budget()
+            sink.append = sink.budget.counting(sink.append)
+            sink.write_mapped = sink.budget.counting(sink.write_mapped)
+        try:
+            self._interpret_codes(self._parsed, ns, sink, {})
+        except Exception:
+            exc_info = sys.exc_info()
+            _annotate_error(exc_info[1], exc_info[2])
+            raise
+
+    def _has_inherit(self):
+        return 'inherit' in _directives(self._parsed)
+
+    def _namespace(self, args, kw, strict=True):
         if args:
             if kw:
                 raise TypeError(
@@ -365,106 +1419,329 @@ class Template(object):
                      "dict-like object (with a .items() method); you gave %r")
                     % (args[0],))
             kw = args[0]
-        ns = copy(kw)
+        if type(kw) is dict:
+            ns = kw.copy()
+        else:
+            from copy import copy
+            ns = copy(kw)
         ns['__template_name__'] = self.name
         if self.namespace:
             ns.update(self.namespace)
-        result, defs, inherit = self._interpret(ns)
-        if not inherit:
-            inherit = self.default_inherit
-        if inherit:
-            result = self._interpret_inherit(result, defs, inherit, ns)
-        return result
+        if self.strict and strict:
+            self._check_names(self.missing_names(ns))
+        if type(ns) is not _LazyNamespace:
+            for value in ns.values():
+                if isinstance(value, lazy):
+                    return _LazyNamespace.wrap(ns)
+        return ns
+
+    def _check_names(self, missing):
+        if missing:
+            raise NameError(self._add_name_info(
+                'Missing template variables: %s' % ', '.join(missing)))
+
+    def render_def(self, name, *args, **kw):
+        """
+        Render only the ``{{def name}}`` block of the template, taking
+        the namespace like ``substitute``.  Only the top-level
+        ``{{default}}`` and ``{{def}}`` directives run before it; the
+        def has to be at the top level of the template.
+        """
+        if self.profiler is not None:
+            return self.profiler.profile(self, self._measured, 'render_def',
+                                         self._render_def, name, args, kw)
+        if self.metrics is not None:
+            return self._measured('render_def', self._render_def, name,
+                                  args, kw)
+        return self._render_def(name, args, kw)
+
+    def _render_def(self, name, args, kw):
+        setup, names = self._def_index()
+        if name not in names:
+            raise TemplateError('No {{def %s}} in template' % name,
+                                position=None, name=self.name)
+        ns = self._namespace(args, kw, strict=False)
+        if self.strict:
+            required = analyze_names(setup)[0] - set(self._globals())
+            self._check_names(sorted(
+                required - set(ns) - set(self.namespace)))
+        if self.limits is not None:
+            out = _BudgetList(self._budget())
+        else:
+            out = []
+        defs = {}
+        try:
+            self._interpret_codes(setup, ns, out, defs)
+            out.append(defs[name]())
+        except Exception:
+            exc_info = sys.exc_info()
+            _annotate_error(exc_info[1], exc_info[2])
+            raise
+        return ''.join(out)
+
+    def specialize(self, **static_ns):
+        """
+        Return a new template for the static names given: expressions,
+        ``{{if}}`` tests and ``{{for}}`` loops depending only on them (and
+        the template namespace) are evaluated once now, the new template
+        keeps the parts depending on the names given when rendering.
+        Builtins and ``default_namespace`` functions are only evaluated
+        now when given too (``specialize(len=len, ...)``).  Expressions
+        are expected to have no side effects.
+        """
+        return self._measured('specialize', self._specialize, static_ns)
+
+    def _specialize(self, static_ns):
+        from copy import copy
+        namespace = dict(self.namespace)
+        namespace.update(static_ns)
+        no_unroll = set()
+        while True:
+            specializer = _Specializer(self, namespace, no_unroll)
+            parsed = specializer.specialize()
+            conflicts = specializer.conflicts(parsed)
+            if not conflicts:
+                break
+            no_unroll.update(conflicts)
+        template = copy(self)
+        template.namespace = namespace
+        template._parsed = parsed
+        template._names = None
+        template._required = None
+        template._defs = None
+        template._expr_code = {}
+        template._render_func = None
+        template._column_specs = {}
+        return template
+
+    def _def_index(self):
+        """
+        Return the top-level ``{{default}}`` and ``{{def}}`` nodes and
+        the set of the def names, computed once.
+        """
+        if self._defs is None:
+            setup = [code for code in self._parsed
+                     if not isinstance(code, _literal_types)
+                     and code[0] in ('default', 'def')]
+            self._defs = setup, frozenset(
+                code[2] for code in setup if code[0] == 'def')
+        return self._defs
+
+    def _budget(self):
+        return _RenderBudget(self.limits)
 
     def _interpret(self, ns):
         # __traceback_hide__ = True
-        parts = []
+        if self.limits is not None:
+            parts = _BudgetList(self._budget())
+        else:
+            parts = []
         defs = {}
-        self._interpret_codes(self._parsed, ns, out=parts, defs=defs)
+        try:
+            self._interpret_codes(self._parsed, ns, out=parts, defs=defs)
+        except Exception:
+            exc_info = sys.exc_info()
+            _annotate_error(exc_info[1], exc_info[2])
+            raise
+        if self.profiler is not None:
+            self.profiler.checkpoint(self)
         if '__inherit__' in defs:
             inherit = defs.pop('__inherit__')
         else:
             inherit = None
         return ''.join(parts), defs, inherit
 
+    def stream(self, *args, **kw):
+        """
+        Substitute the template and return an iterator of the output in
+        chunks, a chunk ends at every ``{{flush}}`` outside of ``{{def}}``
+        blocks.  Encoded it is a streamed WSGI response body.  A template
+        inheriting another one is rendered before the parent is streamed.
+        """
+        return self._stream(self._namespace(args, kw))
+
+    def _stream(self, ns):
+        # __traceback_hide__ = True
+        if self.default_inherit or self._has_inherit():
+            result, defs, inherit = self._interpret(ns)
+            inherit = inherit or self.default_inherit
+            if not inherit:
+                yield result
+                return
+            templ, ns = self._inherit_parent(result, defs, inherit, ns)
+            for chunk in templ._stream(templ._namespace((ns,), {})):
+                yield chunk
+            return
+        if self.limits is not None:
+            out = _BudgetList(self._budget())
+        else:
+            out = []
+        flushing = set()
+        _flush_nodes(self._parsed, flushing)
+        try:
+            for flush in self._stream_codes(self._parsed, ns, out, {},
+                                            flushing):
+                if out:
+                    yield ''.join(out)
+                    del out[:]
+        except Exception:
+            exc_info = sys.exc_info()
+            _annotate_error(exc_info[1], exc_info[2])
+            raise
+        if out:
+            yield ''.join(out)
+
+    def _stream_codes(self, codes, ns, out, defs, flushing):
+        """
+        Interpret codes like ``_interpret_codes``, yielding at every
+        ``{{flush}}``.  Only loops and conditions with a flush in them
+        (the ids in flushing) are walked by this generator.
+        """
+        # __traceback_hide__ = True
+        try:
+            for item in codes:
+                if isinstance(item, basestring_):
+                    out.append(item)
+                elif isinstance(item, MappedText):
+                    item.append_to(out)
+                elif item[0] == 'flush':
+                    yield item
+                elif id(item) not in flushing:
+                    self._interpret_codes((item,), ns, out, defs)
+                elif item[0] == 'cond':
+                    for part in item[2:]:
+                        if part.test(self, ns):
+                            for flush in self._stream_codes(
+                                    part[3], ns, out, defs, flushing):
+                                yield flush
+                            break
+                else:
+                    expr = self._eval(item[3], ns, item[1])
+                    budget = getattr(out, 'budget', None)
+                    if budget is not None:
+                        expr = budget.iterate(expr)
+                    for value in expr:
+                        _bind_loop_vars(item[2], value, ns)
+                        try:
+                            for flush in self._stream_codes(
+                                    item[4], ns, out, defs, flushing):
+                                yield flush
+                        except _TemplateContinue:
+                            continue
+                        except _TemplateBreak:
+                            break
+        except TemplateLimitError as e:
+            if e.position is None and not isinstance(item, _literal_types):
+                e.position, e.name = item[1], self.name
+            raise
+
+    def _interpret_compiled(self, render, ns):
+        # __traceback_hide__ = True
+        defs = {}
+        try:
+            parts = render(self, ns, defs)
+        except Exception:
+            exc_info = sys.exc_info()
+            _annotate_error(exc_info[1], exc_info[2])
+            raise
+        if self.profiler is not None:
+            self.profiler.checkpoint(self)
+        inherit = defs.pop('__inherit__', None)
+        return ''.join(parts), defs, inherit
+
+    def _compile(self):
+        """
+        Compile the template into a Python render function, or return
+        False if the template uses something the compiler cannot express
+        (or overrides ``_repr`` or ``_repr_safe``, which compiled code does
+        not call).
+        """
+        code = self._compile_code()
+        if code is None:
+            return False
+        return self._load_code(*code)
+
+    def _compile_code(self):
+        if self.sandbox is not None:
+            # generated code is plain Python, sandboxed templates are
+            # interpreted with their checked expressions
+            return None
+        if (type(self)._repr is not Template._repr
+                or type(self)._repr_safe is not Template._repr_safe):
+            return None
+        compiler = TemplateCompiler(self)
+        try:
+            source, positions = compiler.compile()
+        except _CompileError:
+            return None
+        if compiler.literals:
+            self._mapped_literals = compiler.literals
+        filename = '<tempita %s>' % (self.name or hex(id(self)))
+        return compile(source, filename, 'exec'), positions
+
+    def _load_code(self, code, positions):
+        if self._literal_table is not None:
+            code = _intern_code(code, self._literal_table)
+        namespace = {
+            '__tempita_template__': (self.name, positions),
+            '_t_CompiledDef': CompiledTemplateDef,
+        }
+        exec(code, namespace)
+        return namespace['_t_render']
+
+    def _globals(self):
+        if self._global_ns is None:
+            ns = dict(vars(_builtins))
+            ns.update(self.default_namespace)
+            self._global_ns = ns
+        return self._global_ns
+
     def _interpret_inherit(self, body, defs, inherit_template, ns):
         # __traceback_hide__ = True
+        templ, ns = self._inherit_parent(body, defs, inherit_template, ns)
+        return templ.substitute(ns)
+
+    def _inherit_parent(self, body, defs, inherit_template, ns):
+        """
+        Return the parent template and its namespace.
+        """
         if not self.get_template:
             raise TemplateError(
                 'You cannot use inheritance without passing in get_template',
                 position=None, name=self.name)
         templ = self.get_template(inherit_template, self)
+        if self.sandbox is not None and templ.sandbox is None:
+            raise TemplateError(
+                'Template %r inherits from %r which is not sandboxed'
+                % (self.name, templ.name), position=None, name=self.name)
         self_ = TemplateObject(self.name)
         for name, value in defs.items():
             setattr(self_, name, value)
         self_.body = body
         ns = ns.copy()
         ns['self'] = self_
-        return templ.substitute(ns)
+        return templ, ns
 
     def _interpret_codes(self, codes, ns, out, defs):
         # __traceback_hide__ = True
-        for item in codes:
-            if isinstance(item, basestring_):
-                out.append(item)
-            else:
-                self._interpret_code(item, ns, out, defs)
-
-    def _interpret_code(self, code, ns, out, defs):
-        # __traceback_hide__ = True
-        name, pos = code[0], code[1]
-        if name == 'continue':
-            raise _TemplateContinue()
-        elif name == 'break':
-            raise _TemplateBreak()
-        elif name == 'for':
-            vars, expr, content = code[2], code[3], code[4]
-            expr = self._eval(expr, ns, pos)
-            self._interpret_for(vars, expr, content, ns, out, defs)
-        elif name == 'cond':
-            parts = code[2:]
-            self._interpret_if(parts, ns, out, defs)
-        elif name == 'expr':
-            parts = code[2].split('|')
-            base = self._eval(parts[0], ns, pos)
-            if len(parts) == 1 and self.default_filter:
-                base = self.default_filter(base)
-            for part in parts[1:]:
-                func = self._eval(part, ns, pos)
-                base = func(base)
-            out.append(self._repr(base, pos))
-        elif name == 'default':
-            var, expr = code[2], code[3]
-            if var not in ns:
-                result = self._eval(expr, ns, pos)
-                ns[var] = result
-        elif name == 'inherit':
-            expr = code[2]
-            value = self._eval(expr, ns, pos)
-            defs['__inherit__'] = value
-        elif name == 'def':
-            name = code[2]
-            #signature = code[3]
-            parts = code[4]
-            ns[name] = defs[name] = TemplateDef(
-                self, name, body=parts, ns=ns, pos=pos)
-        elif name == 'comment':
-            return
-        else:
-            assert 0, "Unknown code: %r" % name
+        try:
+            for item in codes:
+                if isinstance(item, basestring_):
+                    out.append(item)
+                else:
+                    item.interpret(self, ns, out, defs)
+        except TemplateLimitError as e:
+            if e.position is None and not isinstance(item, _literal_types):
+                e.position, e.name = item[1], self.name
+            raise
 
     def _interpret_for(self, vars, expr, content, ns, out, defs):
         # __traceback_hide__ = True
+        budget = getattr(out, 'budget', None)
+        if budget is not None:
+            expr = budget.iterate(expr)
         for item in expr:
-            if len(vars) == 1:
-                ns[vars[0]] = item
-            else:
-                if len(vars) != len(item):
-                    raise ValueError(
-                        'Need %i items to unpack (got %i items)'
-                        % (len(vars), len(item)))
-                for name, value in zip(vars, item):
-                    ns[name] = value
+            _bind_loop_vars(vars, item, ns)
             try:
                 self._interpret_codes(content, ns, out, defs)
             except _TemplateContinue:
@@ -472,108 +1749,290 @@ class Template(object):
             except _TemplateBreak:
                 break
 
-    def _interpret_if(self, parts, ns, out, defs):
-        # __traceback_hide__ = True
-        # @@: if/else/else gets through
-        for part in parts:
-            assert not isinstance(part, basestring_)
-            name, pos = part[0], part[1]
-            if name == 'else':
-                result = True
+    def _column_spec(self, code):
+        # keyed by the node, unrolled loops of a specialized template copy
+        # a node with its position; the node is kept to keep its id unique
+        entry = self._column_specs.get(id(code))
+        if entry is None:
+            # limits are checked row by row, not after building the table,
+            # and an overridden _repr is called for every value
+            entry = self._column_specs[id(code)] = code, (
+                self._unicode and self.default_filter is None
+                and self.limits is None
+                and type(self)._repr is Template._repr
+                and column_spec(code) or False)
+        return entry[1]
+
+    def _render_columns(self, spec, rows):
+        """
+        Render a loop recognized by ``column_spec`` for all rows at once:
+        every cell expression is extracted column-wise, converted and the
+        rows are formatted with a single format string.  Returns a tuple
+        ``(text, rows)`` with rows as a sequence; text is None if the rows
+        have to be rendered one by one (for example to report an error).
+        """
+        fmt, getters = spec
+        names = getattr(getattr(rows, 'dtype', None), 'names', None)
+        if not names and not isinstance(rows, (list, tuple)):
+            rows = list(rows)
+        try:
+            columns = [self._convert_column(_table_column(rows, steps, names))
+                       for steps in getters]
+        except Exception:
+            return None, rows
+        if not columns:
+            return fmt * len(rows), rows
+        return ''.join(map(fmt.__mod__, zip(*columns))), rows
+
+    def _convert_column(self, column):
+        """
+        Convert a list of expression results like ``_convert`` does for
+        each of them; text and numbers are left to the format string.
+        """
+        kinds = set(map(type, column))
+        if type(None) in kinds:
+            kinds.discard(type(None))
+            column = ['' if value is None else value for value in column]
+        if kinds <= _plain_types and type(self)._convert is Template._convert:
+            return column
+        return list(map(self._convert, column))
+
+    def _compile_sandboxed(self, codes, exprs):
+        """
+        Check all expressions with the sandbox, return a dict of the
+        expressions to the functions evaluating them.
+        """
+        functions, names = {}, {}
+        for ns in (self.default_namespace, self.namespace):
+            for name, value in ns.items():
+                if callable(value):
+                    functions[name] = value
+                else:
+                    names[name] = value
+        functions.update(self.sandbox.functions)
+        for code in codes:
+            if isinstance(code, _literal_types):
+                continue
+            pos = code[1]
+            if code.kind in ('expr', 'safe'):
+                parts = code[2].split('|')
+                expressions = [(part, i > 0) for i, part in enumerate(parts)]
+            elif code.kind in ('for', 'default'):
+                expressions = [(code[3], False)]
+            elif code.kind == 'inherit':
+                expressions = [(code[2], False)]
+            elif code.kind == 'cond':
+                expressions = [(part[2], False) for part in code[2:]
+                               if part[2] is not None]
             else:
-                result = self._eval(part[2], ns, pos)
-            if result:
-                self._interpret_codes(part[3], ns, out, defs)
-                break
+                expressions = []
+            for expr, is_filter in expressions:
+                if expr in exprs:
+                    continue
+                try:
+                    exprs[expr] = self.sandbox.compile(
+                        expr, functions, filter=is_filter, names=names)
+                except ValueError as e:
+                    raise TemplateError(str(e), position=pos, name=self.name)
+            if code.kind in ('for', 'def'):
+                self._compile_sandboxed(code[4], exprs)
+            elif code.kind == 'cond':
+                for part in code[2:]:
+                    self._compile_sandboxed(part[3], exprs)
+        return exprs
 
     def _eval(self, code, ns, pos):
         # __traceback_hide__ = True
+        # errors get the position (pos) of the expression added by the
+        # handler of the render, see _annotate_error
+        if self.sandbox is not None:
+            return self._safe_exprs[code](ns)
+        compiled = self._expr_code.get(code)
+        if compiled is None:
+            compiled = self._compile_expr(code)
+        if type(compiled) is tuple:
+            # comprehensions and lambdas only see the globals of eval, give
+            # them the names they read like the compiled render functions
+            compiled, names = compiled
+            scope = dict(self.default_namespace)
+            for name in names:
+                if name in ns:
+                    scope[name] = ns[name]
+            return eval(compiled, scope)
+        return eval(compiled, self.default_namespace, ns)
+
+    def _compile_expr(self, code):
         try:
-            try:
-                value = eval(code, self.default_namespace, ns)
-            except SyntaxError as e:
-                raise SyntaxError(
-                    'invalid syntax in expression: %s' % code)
-            return value
-        except:
-            exc_info = sys.exc_info()
-            e = exc_info[1]
-            if getattr(e, 'args', None):
-                arg0 = e.args[0]
-            else:
-                arg0 = coerce_text(e)
-            e.args = (self._add_line_info(arg0, pos),)
-            #raise (exc_info[1], e, exc_info[2])
-            raise
+            compiled = compile(code.strip(), '<string>', 'eval')
+        except SyntaxError:
+            raise SyntaxError('invalid syntax in expression: %s' % code)
+        if [const for const in compiled.co_consts
+                if isinstance(const, type(compiled))]:
+            compiled = compiled, expression_names(code)
+        self._expr_code[code] = compiled
+        return compiled
 
     def _repr(self, value, pos):
         # __traceback_hide__ = True
-        try:
-            if value is None:
-                return ''
-            if self._unicode:
-                try:
-                    value = unicode(value)
-                except UnicodeDecodeError:
-                    value = bytes(value)
-            else:
-                if not isinstance(value, basestring_):
-                    value = coerce_text(value)
-                if (isinstance(value, unicode) and self.default_encoding):
-                    value = value.encode(self.default_encoding)
-        except:
-            exc_info = sys.exc_info()
-            e = exc_info[1]
-            e.args = (self._add_line_info(e.args[0], pos),)
-            #raise(exc_info[1], e, exc_info[2])
-            raise
+        return self._convert(value)
+
+    def _repr_safe(self, value, pos):
+        # __traceback_hide__ = True
+        return self._convert_safe(value)
+
+    def _convert(self, value):
+        """
+        Convert an expression result to the text inserted into the output.
+        """
+        if value is None:
+            return ''
+        if self._unicode:
+            try:
+                value = unicode(value)
+            except UnicodeDecodeError:
+                value = bytes(value)
         else:
-            if self._unicode and isinstance(value, bytes):
-                if not self.default_encoding:
-                    raise UnicodeDecodeError(
-                        'Cannot decode bytes value %r into unicode '
-                        '(no default_encoding provided)' % value)
-                try:
-                    value = value.decode(self.default_encoding)
-                except UnicodeDecodeError as e:
-                    raise UnicodeDecodeError(
-                        e.encoding,
-                        e.object,
-                        e.start,
-                        e.end,
-                        e.reason + ' in string %r' % value)
-            elif not self._unicode and isinstance(value, unicode):
-                if not self.default_encoding:
-                    raise UnicodeEncodeError(
-                        'Cannot encode unicode value %r into bytes '
-                        '(no default_encoding provided)' % value)
+            if not isinstance(value, basestring_):
+                value = coerce_text(value)
+            if (isinstance(value, unicode) and self.default_encoding):
                 value = value.encode(self.default_encoding)
-            return value
+        if self._unicode and isinstance(value, bytes):
+            if not self.default_encoding:
+                raise UnicodeDecodeError(
+                    'Cannot decode bytes value %r into unicode '
+                    '(no default_encoding provided)' % value)
+            try:
+                value = value.decode(self.default_encoding)
+            except UnicodeDecodeError as e:
+                raise UnicodeDecodeError(
+                    e.encoding,
+                    e.object,
+                    e.start,
+                    e.end,
+                    e.reason + ' in string %r' % value)
+        elif not self._unicode and isinstance(value, unicode):
+            if not self.default_encoding:
+                raise UnicodeEncodeError(
+                    'Cannot encode unicode value %r into bytes '
+                    '(no default_encoding provided)' % value)
+            value = value.encode(self.default_encoding)
+        return value
+
+    def _convert_safe(self, value):
+        """
+        Convert the value of a ``{{expr | safe}}``, never quoted.
+        """
+        return Template._convert(self, value)
+
+    def _convert_number(self, value):
+        """
+        Convert the value of an expression the compiler expects to be a
+        number, other values are left to ``_convert``.
+        """
+        if type(value) in _number_types:
+            return unicode(value)
+        return self._convert(value)
 
     def _add_line_info(self, msg, pos):
-        msg = "%s at line %s column %s" % (
-            msg, pos[0], pos[1])
+        return _add_line_info(msg, pos, self.name)
+
+    def _add_name_info(self, msg):
         if self.name:
             msg += " in file %s" % self.name
         return msg
 
 
+def _add_line_info(msg, pos, name):
+    msg = "%s at line %s column %s" % (
+        msg, pos[0], pos[1])
+    if name:
+        msg += " in file %s" % name
+    return msg
+
+
+class TemplateCache(object):
+    """
+    Bounded, thread safe cache of templates created from source strings,
+    used by ``sub`` and ``sub_html`` (as ``template_cache``).  The least
+    recently used template is dropped when the cache is full.
+
+    :param int maxsize: Maximum number of templates kept.
+    """
+
+    def __init__(self, maxsize=256):
+        try:
+            from _thread import allocate_lock
+        except ImportError:
+            from thread import allocate_lock
+        self.maxsize = maxsize
+        self.templates = {}
+        self.hits = self.misses = self.evictions = 0
+        self.lock = allocate_lock()
+
+    def __repr__(self):
+        return '<%s %i/%i templates>' % (
+            self.__class__.__name__, len(self.templates), self.maxsize)
+
+    def get(self, template_class, content, name=None, delimeters=None):
+        """
+        Return the template of content, created if it is not cached.
+        """
+        if delimeters is not None:
+            delimeters = tuple(delimeters)
+        key = (template_class, content, name, delimeters)
+        with self.lock:
+            template = self.templates.pop(key, None)
+            if template is not None:
+                # reinsert as the most recently used
+                self.templates[key] = template
+                self.hits += 1
+                return template
+            self.misses += 1
+        template = template_class(content, name=name, delimeters=delimeters)
+        with self.lock:
+            self.templates[key] = template
+            while len(self.templates) > self.maxsize:
+                del self.templates[next(iter(self.templates))]
+                self.evictions += 1
+        return template
+
+    def stats(self):
+        """
+        Return a dict with the ``hits``, ``misses``, ``evictions``,
+        ``size`` and ``maxsize`` of the cache.
+        """
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, size=len(self.templates),
+                        maxsize=self.maxsize)
+
+    def clear(self):
+        """
+        Drop all templates and reset the statistics.
+        """
+        with self.lock:
+            self.templates.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+template_cache = TemplateCache()
+
+
 def sub(content, delimeters=None, **kw):
     """
     Create a Template and substitute it with provided parameters.
     Handy function to do all in one step.
     If no keyword parameters are given the local context
-    of the caller is used.
+    of the caller is used.  Templates are kept in ``template_cache``.
     """
     if not kw:
-        frame = inspect.currentframe()
+        frame = sys._getframe(1)
         try:
-            kw = frame.f_back.f_locals
+            kw = frame.f_locals
         finally:
             del frame
-    print(kw)
     name = kw.get('__name')
-    tmpl = Template(content, name=name, delimeters=delimeters)
+    tmpl = template_cache.get(Template, content, name, delimeters)
     return tmpl.substitute(kw)
 
 
@@ -606,16 +2065,22 @@ def html_quote(value, force=True):
     if not isinstance(value, basestring_):
         value = coerce_text(value)
     if not PY2 and isinstance(value, bytes):
-        value = cgi.escape(value.decode('latin1'), 1)
+        value = _html_escape(value.decode('latin1'))
         value = value.encode('latin1')
     else:
-        value = cgi.escape(value, 1)
+        value = _html_escape(value)
     if PY2:
         if isinstance(value, unicode):
             value = value.encode('ascii', 'xmlcharrefreplace')
     return value
 
 
+def _html_escape(value):
+    # the same as cgi.escape(value, True), which newer Pythons lack
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
 def url(v):
     if PY2:
         from urllib import quote
@@ -641,6 +2106,13 @@ def attr(**kw):
 
 
 class HTMLTemplate(Template):
+    """
+    Template quoting expression values for HTML.
+
+    Takes the arguments of ``Template`` and ``minify``: collapse the
+    whitespace of the template text (see ``minify_html``) when the
+    template is created.
+    """
 
     default_namespace = Template.default_namespace.copy()
     default_namespace.update(dict(
@@ -648,35 +2120,217 @@ class HTMLTemplate(Template):
         attr=attr,
         url=url,
         html_quote=html_quote))
+    minify = False
 
-    def _repr(self, value, pos):
+    def __init__(self, *args, **kw):
+        minify = kw.pop('minify', None)
+        if minify is not None:
+            self.minify = minify
+        Template.__init__(self, *args, **kw)
+        if self.minify:
+            minify_html(self._parsed)
+
+    def _convert(self, value):
         if hasattr(value, '__html__'):
             value = value.__html__()
             quote = False
         else:
             quote = True
-        plain = Template._repr(self, value, pos)
+        plain = Template._convert(self, value)
         if quote:
             return html_quote(plain)
         else:
             return plain
 
+    def _convert_safe(self, value):
+        if hasattr(value, '__html__'):
+            value = value.__html__()
+        return Template._convert(self, value)
+
+    def _convert_markup(self, value):
+        """
+        Convert the value of an expression the compiler expects to be
+        ``html`` (from ``html()`` or ``attr()``), without probing for
+        ``__html__``.
+        """
+        if type(value) is html:
+            return Template._convert(self, value.value)
+        return self._convert(value)
+
+    def _convert_column(self, column):
+        if type(self)._convert is HTMLTemplate._convert:
+            kinds = set(map(type, column))
+            if kinds <= _number_types:
+                return column
+            if kinds == _text_types:
+                return list(map(html_quote, column))
+        return Template._convert_column(self, column)
+
+
+def minify_html(codes, state=None):
+    """
+    Collapse every run of whitespace in the text of a parse tree to a
+    single space (or newline if it contains one), except inside
+    ``pre``, ``textarea``, ``script`` and ``style`` elements and quoted
+    attribute values.  The tree is changed in place and returned.
+    """
+    if state is None:
+        # the raw text element the text is in, whether it is in a tag and
+        # the quote of the attribute value it is in
+        state = [None, False, None]
+    for index, code in enumerate(codes):
+        if isinstance(code, MappedText):
+            code = code.text()
+        if isinstance(code, unicode):
+            codes[index] = _minify_text(code, state)
+        elif isinstance(code, Node):
+            if code[0] in ('for', 'def'):
+                minify_html(code[4], state)
+            elif code[0] == 'cond':
+                for part in code[2:]:
+                    minify_html(part[3], state)
+    return codes
+
+
+def _minify_text(text, state):
+    out = []
+    last = 0
+    for match in _raw_tag_re.finditer(text):
+        closing, tag = match.group(1), match.group(2).lower()
+        if state[0] is None and not closing:
+            out.append(_minify_markup(text[last:match.start()], state))
+            out.append(match.group(0))
+            last = match.end()
+            state[0] = tag
+        elif state[0] == tag and closing:
+            out.append(text[last:match.end()])
+            last = match.end()
+            state[0] = None
+    if state[0] is None:
+        out.append(_minify_markup(text[last:], state))
+    else:
+        out.append(text[last:])
+    return ''.join(out)
+
+
+def _minify_markup(text, state):
+    out = []
+    last = 0
+    for match in _markup_re.finditer(text):
+        token = match.group(0)
+        if state[2] is not None:
+            if token == state[2]:
+                state[2] = None
+        elif token[0] == '<':
+            state[1] = True
+        elif token == '>':
+            state[1] = False
+        elif token in ('"', "'"):
+            if state[1]:
+                state[2] = token
+        else:
+            out.append(text[last:match.start()])
+            out.append(_collapse_space(match))
+            last = match.end()
+    out.append(text[last:])
+    return ''.join(out)
+
+
+def _collapse_space(match):
+    return '\n' if '\n' in match.group(0) else ' '
+
+
+_raw_tag_re = re.compile(r'<(/?)(pre|textarea|script|style)\b[^>]*>', re.I)
+# only HTML whitespace, not non-breaking spaces, and what starts or ends
+# tags and attribute values
+_markup_re = re.compile(r'[ \t\r\n\f]+|<[a-zA-Z/!]|[>"\']')
+
 
 def sub_html(content, **kw):
     name = kw.get('__name')
-    tmpl = HTMLTemplate(content, name=name)
+    tmpl = template_cache.get(HTMLTemplate, content, name)
     return tmpl.substitute(kw)
 
 
+class lazy(object):
+    """
+    A namespace value computed on first use: ``func`` is called without
+    arguments the first time the template reads the name, and the result
+    is reused for the rest of that render (including ``def`` blocks and
+    inherited templates).
+    """
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.func)
+
+
+class _LazyValue(lazy):
+    """
+    The per-render memo of a ``lazy`` value, shared by all copies of the
+    namespace of one render.
+    """
+
+    __slots__ = ('value', 'resolved')
+
+    def __init__(self, func):
+        self.func = func
+        self.resolved = False
+
+    def get(self):
+        if not self.resolved:
+            self.value = self.func()
+            self.resolved = True
+        return self.value
+
+
+class _LazyNamespace(dict):
+    """
+    A render namespace holding ``lazy`` values, they are resolved by
+    item access (which is what ``eval`` uses for its locals).
+    """
+
+    @classmethod
+    def wrap(cls, ns):
+        wrapped = cls(ns)
+        for name, value in ns.items():
+            if type(value) is lazy:
+                dict.__setitem__(wrapped, name, _LazyValue(value.func))
+        return wrapped
+
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        if type(value) is _LazyValue:
+            value = value.get()
+            dict.__setitem__(self, name, value)
+        return value
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def copy(self):
+        # values not read yet stay shared memos between the copies
+        return self.__class__(self)
+
+    __copy__ = copy
+
+
 class TemplateDef(object):
     def __init__(self, template, func_name,
-                 body, ns, pos, bound_self=None):
+                 body, ns, pos, bound_self=None, budget=None):
         self._template = template
         self._func_name = func_name
         self._body = body
         self._ns = ns
         self._pos = pos
         self._bound_self = bound_self
+        self._budget = budget
 
     def __repr__(self):
         return '<tempita function %s at %s:%s>' % (
@@ -690,7 +2344,11 @@ class TemplateDef(object):
         #ns.update(values)
         if self._bound_self is not None:
             ns['self'] = self._bound_self
-        out = []
+        if self._budget is not None:
+            # the output is counted where it is used
+            out = _BudgetList(self._budget, counted=False)
+        else:
+            out = []
         subdefs = {}
         self._template._interpret_codes(self._body, ns, out, subdefs)
         return ''.join(out)
@@ -700,7 +2358,18 @@ class TemplateDef(object):
             return self
         return self.__class__(
             self._template, self._func_name,
-            self._body, self._ns, self._pos, bound_self=obj)
+            self._body, self._ns, self._pos, bound_self=obj,
+            budget=self._budget)
+
+
+class CompiledTemplateDef(TemplateDef):
+    """
+    A ``{{def}}`` block of a compiled template, the body is a closure of
+    the generated render function.
+    """
+
+    def __call__(self, *args, **kw):
+        return ''.join(self._body())
 
 
 class TemplateObject(object):
@@ -751,6 +2420,422 @@ class _Empty(object):
 Empty = _Empty()
 del _Empty
 
+############################################################
+## Memory mapped templates
+############################################################
+
+
+class MappedText(object):
+    """
+    A slice of a memory mapped template file, used for literal text
+    instead of a string.  ``text()`` materializes it (decoded if the
+    template has an encoding); ``write_to`` writes the raw bytes to a
+    binary file without an intermediate copy.  Encodings have to be
+    ASCII compatible.
+    """
+
+    __slots__ = ('buffer', 'start', 'end', 'encoding')
+
+    def __init__(self, buffer, start, end, encoding=None):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.encoding = encoding
+
+    def __repr__(self):
+        return '<%s %i:%i>' % (self.__class__.__name__, self.start, self.end)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(self.end - self.start)
+        return self.slice(self.start + start, self.start + max(start, stop))
+
+    def slice(self, start, end):
+        return self.__class__(self.buffer, start, end, self.encoding)
+
+    def text(self):
+        value = self.buffer[self.start:self.end]
+        if self.encoding:
+            value = value.decode(self.encoding)
+        return value
+
+    def strip(self):
+        start = _mapped_space_re.match(
+            self.buffer, self.start, self.end).end()
+        end = self.end
+        while end > start and self.buffer[end - 1:end].isspace():
+            end -= 1
+        return self.slice(start, end)
+
+    def search(self, regex):
+        """
+        Search with one of the whitespace regexes of ``trim_lex``, the
+        match is returned with positions relative to this text.
+        """
+        mapped_re, method = _mapped_regexes[regex]
+        match = getattr(mapped_re, method)(self.buffer, self.start, self.end)
+        if match is None:
+            return None
+        return _MappedMatch(match.start() - self.start,
+                            match.end() - self.start)
+
+    def interpret(self, template, ns, out, defs):
+        self.append_to(out)
+
+    def append_to(self, out):
+        write = getattr(out, 'write_mapped', None)
+        if write is None:
+            out.append(self.text())
+        else:
+            write(self)
+
+    def write_to(self, fileobj):
+        fileobj.write(memoryview(self.buffer)[self.start:self.end])
+
+
+class _MappedMatch(object):
+
+    def __init__(self, start, end):
+        self._start = start
+        self._end = end
+
+    def start(self):
+        return self._start
+
+    def end(self):
+        return self._end
+
+
+class _FileSink(object):
+    """
+    Output list replacement writing every appended chunk to a file.
+    With an ``encoding`` the file is binary and mapped text is written
+    as is.
+    """
+
+    def __init__(self, fileobj, encoding=None):
+        if encoding:
+            self.append = lambda value: fileobj.write(value.encode(encoding))
+            self.write_mapped = lambda text: text.write_to(fileobj)
+        else:
+            self.append = fileobj.write
+            self.write_mapped = lambda text: fileobj.write(text.text())
+        self.flush = getattr(fileobj, 'flush', None)
+
+
+def map_file(filename, encoding=None):
+    """
+    Memory map a file and return its content as ``MappedText``, or None
+    for an empty file (which cannot be mapped).
+    """
+    import mmap
+    with open(filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedText(buffer, 0, len(buffer), encoding)
+
+
+_mapped_space_re = re.compile(br'\s*')
+
+if isinstance(basestring_, tuple):
+    _literal_types = basestring_ + (MappedText,)
+else:
+    _literal_types = (basestring_, MappedText)
+
+
+############################################################
+## Parse tree
+############################################################
+
+
+def _field(index):
+    return property(lambda self: self[index])
+
+
+class Node(tuple):
+    """
+    Base class of the parse tree nodes.  Nodes are tuples
+    ``(kind, pos, field...)`` (so they take no more memory than plain
+    tuples and compare equal to them) with named fields.  Statements
+    interpret themselves in ``interpret(template, ns, out, defs)``, the
+    parts of a ``CondNode`` have ``test(template, ns)`` instead.
+    """
+
+    __slots__ = ()
+    kind = None
+
+    def __new__(cls, pos, *fields):
+        return tuple.__new__(cls, (cls.kind, pos) + fields)
+
+    def __getnewargs__(self):
+        return tuple(self[1:])
+
+    pos = _field(1)
+
+    def to_tuple(self):
+        """
+        Return the node as nested plain tuples and lists.
+        """
+        return tuple(map(_plain_node, self))
+
+
+def _plain_node(value):
+    if isinstance(value, Node):
+        return value.to_tuple()
+    elif isinstance(value, list):
+        return list(map(_plain_node, value))
+    return value
+
+
+def _node_from_tuple(code):
+    """
+    Rebuild a node from ``Node.to_tuple()``, literal text is returned
+    as is.
+    """
+    if not isinstance(code, tuple):
+        return code
+    cls = _node_classes[code[0]]
+    fields = list(code[2:])
+    if cls is CondNode:
+        fields = list(map(_node_from_tuple, fields))
+    elif code[0] in ('for', 'def'):
+        fields[2] = list(map(_node_from_tuple, fields[2]))
+    elif code[0] in ('if', 'elif', 'else'):
+        fields[1] = list(map(_node_from_tuple, fields[1]))
+    return cls(code[1], *fields)
+
+
+class ContinueNode(Node):
+    __slots__ = ()
+    kind = 'continue'
+
+    def interpret(self, template, ns, out, defs):
+        raise _TemplateContinue()
+
+
+class BreakNode(Node):
+    __slots__ = ()
+    kind = 'break'
+
+    def interpret(self, template, ns, out, defs):
+        raise _TemplateBreak()
+
+
+class FlushNode(Node):
+    """
+    ``{{flush}}``, the output so far is sent to the consumer of a
+    streamed render (``Template.stream``, or the file of ``render_to``).
+    """
+
+    __slots__ = ()
+    kind = 'flush'
+
+    def interpret(self, template, ns, out, defs):
+        flush = getattr(out, 'flush', None)
+        if flush is not None:
+            flush()
+
+
+class CommentNode(Node):
+    __slots__ = ()
+    kind = 'comment'
+    comment = _field(2)
+
+    def interpret(self, template, ns, out, defs):
+        pass
+
+
+class ExprNode(Node):
+    __slots__ = ()
+    kind = 'expr'
+    expr = _field(2)
+
+    def interpret(self, template, ns, out, defs):
+        # __traceback_hide__ = True
+        value = self.evaluate(template, ns, template.default_filter)
+        out.append(template._repr(value, self[1]))
+
+    def evaluate(self, template, ns, default_filter=None):
+        # __traceback_hide__ = True
+        parts = self[2].split('|')
+        pos = self[1]
+        base = template._eval(parts[0], ns, pos)
+        if len(parts) == 1 and default_filter:
+            base = default_filter(base)
+        for part in parts[1:]:
+            func = template._eval(part, ns, pos)
+            base = func(base)
+        return base
+
+
+class SafeNode(ExprNode):
+    """
+    ``{{expr | safe}}``, the value is inserted without quoting.
+    """
+
+    __slots__ = ()
+    kind = 'safe'
+
+    def interpret(self, template, ns, out, defs):
+        # __traceback_hide__ = True
+        value = self.evaluate(template, ns)
+        out.append(template._repr_safe(value, self[1]))
+
+
+class ForNode(Node):
+    __slots__ = ()
+    kind = 'for'
+    vars = _field(2)
+    expr = _field(3)
+    content = _field(4)
+
+    def interpret(self, template, ns, out, defs):
+        # __traceback_hide__ = True
+        vars = self[2]
+        expr = template._eval(self[3], ns, self[1])
+        spec = template._column_spec(self)
+        if spec:
+            text, expr = template._render_columns(spec, expr)
+            if text is not None:
+                out.append(text)
+                if len(expr):
+                    ns[vars[0]] = expr[-1]
+                return
+        template._interpret_for(vars, expr, self[4], ns, out, defs)
+
+
+class CondNode(Node):
+    """
+    ``('cond', pos, part...)`` with ``IfNode``, ``ElifNode`` and
+    ``ElseNode`` parts.
+    """
+
+    __slots__ = ()
+    kind = 'cond'
+
+    parts = property(lambda self: self[2:])
+
+    def interpret(self, template, ns, out, defs):
+        # __traceback_hide__ = True
+        for part in self[2:]:
+            if part.test(template, ns):
+                template._interpret_codes(part[3], ns, out, defs)
+                break
+
+
+class IfNode(Node):
+    __slots__ = ()
+    kind = 'if'
+    expr = _field(2)
+    content = _field(3)
+
+    def test(self, template, ns):
+        return template._eval(self[2], ns, self[1])
+
+
+class ElifNode(IfNode):
+    __slots__ = ()
+    kind = 'elif'
+
+
+class ElseNode(Node):
+    __slots__ = ()
+    kind = 'else'
+    expr = _field(2)
+    content = _field(3)
+
+    def test(self, template, ns):
+        return True
+
+
+class DefaultNode(Node):
+    __slots__ = ()
+    kind = 'default'
+    var = _field(2)
+    expr = _field(3)
+
+    def interpret(self, template, ns, out, defs):
+        # __traceback_hide__ = True
+        if self[2] not in ns:
+            ns[self[2]] = template._eval(self[3], ns, self[1])
+
+
+class InheritNode(Node):
+    __slots__ = ()
+    kind = 'inherit'
+    expr = _field(2)
+
+    def interpret(self, template, ns, out, defs):
+        # __traceback_hide__ = True
+        defs['__inherit__'] = template._eval(self[2], ns, self[1])
+
+
+class DefNode(Node):
+    __slots__ = ()
+    kind = 'def'
+    name = _field(2)
+    signature = _field(3)
+    content = _field(4)
+
+    def interpret(self, template, ns, out, defs):
+        name = self[2]
+        ns[name] = defs[name] = TemplateDef(
+            template, name, body=self[4], ns=ns, pos=self[1],
+            budget=getattr(out, 'budget', None))
+
+
+_node_classes = dict((cls.kind, cls) for cls in [
+    ContinueNode, BreakNode, FlushNode, CommentNode, ExprNode, SafeNode, ForNode,
+    CondNode, IfNode, ElifNode, ElseNode, DefaultNode, InheritNode, DefNode])
+
+
+def _flush_nodes(codes, found):
+    """
+    Add the ids of the loop and condition nodes with a ``{{flush}}`` in
+    them (not counting ``{{def}}`` blocks) to found, return True if there
+    is a flush in codes.
+    """
+    flush = False
+    for code in codes:
+        if isinstance(code, _literal_types):
+            continue
+        if code[0] == 'flush':
+            flush = True
+            continue
+        elif code[0] == 'for':
+            contents = [code[4]]
+        elif code[0] == 'cond':
+            contents = [part[3] for part in code[2:]]
+        else:
+            continue
+        for content in contents:
+            if _flush_nodes(content, found):
+                found.add(id(code))
+        flush = flush or id(code) in found
+    return flush
+
+
+def _directives(codes, found=None):
+    """
+    Return the set of directive names used in a parse tree.
+    """
+    if found is None:
+        found = set()
+    for code in codes:
+        if isinstance(code, _literal_types):
+            continue
+        found.add(code[0])
+        if code[0] in ('for', 'def'):
+            _directives(code[4], found)
+        elif code[0] == 'cond':
+            for part in code[2:]:
+                _directives(part[3], found)
+    return found
+
+
 ############################################################
 ## Lexing and Parsing
 ############################################################
@@ -760,6 +2845,8 @@ def lex(s, name=None, trim_whitespace=True, line_offset=0, delimeters=None):
     if delimeters is None:
         delimeters = (Template.default_namespace['start_braces'],
                       Template.default_namespace['end_braces'])
+    if isinstance(s, MappedText):
+        return lex_mapped(s, name, trim_whitespace, line_offset, delimeters)
     in_expr = False
     chunks = []
     last = 0
@@ -841,19 +2928,23 @@ Lex a string into chunks:
 
 #statement_re = re.compile(r'^(?:if |elif |for |def |inherit |default |py:)')
 statement_re = re.compile(r'^(?:if |elif |for |def |inherit |default)')
-single_statements = frozenset(['else', 'endif', 'endfor', 'enddef', 'continue', 'break'])
+single_statements = frozenset(['else', 'endif', 'endfor', 'enddef', 'continue', 'break', 'flush'])
 trail_whitespace_re = re.compile(r'\n\r?[\t ]*$')
 lead_whitespace_re = re.compile(r'^[\t ]*\n')
+_mapped_regexes = {
+    trail_whitespace_re: (re.compile(br'\n\r?[\t ]*$'), 'search'),
+    lead_whitespace_re: (re.compile(br'[\t ]*\n'), 'match'),
+}
 
 _statements = tuple("if elif for def inherit default else endif endfor"
-                        " enddef continue break".split())
+                        " enddef continue break flush".split())
 
 
 def trim_lex(tokens):
     last_trim = None
     for i in range(len(tokens)):
         current = tokens[i]
-        if isinstance(tokens[i], basestring_):
+        if isinstance(tokens[i], _literal_types):
             # we don't trim this
             continue
         item = current[0].strip()
@@ -869,22 +2960,22 @@ def trim_lex(tokens):
         else:
             next_chunk = tokens[i + 1]
         if (not
-                isinstance(next_chunk, basestring_)
-                or not isinstance(prev, basestring_)):
+                isinstance(next_chunk, _literal_types)
+                or not isinstance(prev, _literal_types)):
             continue
-        prev_ok = not prev or trail_whitespace_re.search(prev)
+        prev_ok = not prev or _search(trail_whitespace_re, prev)
         if i == 1 and not prev.strip():
             prev_ok = True
         if last_trim is not None and last_trim + 2 == i and not prev.strip():
             prev_ok = 'last'
         if (prev_ok
-            and (not next_chunk or lead_whitespace_re.search(next_chunk)
+            and (not next_chunk or _search(lead_whitespace_re, next_chunk)
                  or (i == len(tokens) - 2 and not next_chunk.strip()))):
             if prev:
                 if ((i == 1 and not prev.strip()) or prev_ok == 'last'):
                     tokens[i - 1] = ''
                 else:
-                    m = trail_whitespace_re.search(prev)
+                    m = _search(trail_whitespace_re, prev)
                     # +1 to leave the leading \n on:
                     prev = prev[:m.start() + 1]
                     tokens[i - 1] = prev
@@ -893,11 +2984,17 @@ def trim_lex(tokens):
                 if i == len(tokens) - 2 and not next_chunk.strip():
                     tokens[i + 1] = ''
                 else:
-                    m = lead_whitespace_re.search(next_chunk)
+                    m = _search(lead_whitespace_re, next_chunk)
                     next_chunk = next_chunk[m.end():]
                     tokens[i + 1] = next_chunk
     return tokens
 
+
+def _search(regex, chunk):
+    if isinstance(chunk, MappedText):
+        return chunk.search(regex)
+    return regex.search(chunk)
+
 trim_lex.__doc__ = r"""
     Takes a lexed set of tokens, and removes whitespace when there is
     a directive on a line by itself:
@@ -919,6 +3016,74 @@ trim_lex.__doc__ = r"""
     """
 
 
+def lex_mapped(text, name=None, trim_whitespace=True, line_offset=0,
+               delimeters=None):
+    """
+    Lex a ``MappedText`` like ``lex`` without copying the buffer: literal
+    chunks are ``MappedText`` slices, only expressions are decoded.
+    """
+    buf, encoding = text.buffer, text.encoding or 'ascii'
+    start = [delimeter.encode(encoding) for delimeter in delimeters]
+    in_expr = False
+    chunks = []
+    last = text.start
+    last_pos = (line_offset + 1, 1)
+    token_re = re.compile(re.escape(start[0]) + b'|' + re.escape(start[1]))
+    for match in token_re.finditer(buf, text.start, text.end):
+        expr = match.group(0)
+        pos = _find_mapped_position(buf, match.end(), last, last_pos,
+                                    text.encoding)
+        if expr == start[0] and in_expr:
+            raise TemplateError('%s inside expression' % delimeters[0],
+                                position=pos,
+                                name=name)
+        elif expr == start[1] and not in_expr:
+            raise TemplateError('%s outside expression' % delimeters[1],
+                                position=pos,
+                                name=name)
+        if expr == start[0]:
+            if match.start() > last:
+                chunks.append(text.slice(last, match.start()))
+            in_expr = True
+        else:
+            chunks.append((
+                buf[last:match.start()].decode(encoding), last_pos))
+            in_expr = False
+        last = match.end()
+        last_pos = pos
+    if in_expr:
+        raise TemplateError('No %s to finish last expression' % delimeters[1],
+                            name=name, position=last_pos)
+    if text.end > last:
+        chunks.append(text.slice(last, text.end))
+    if trim_whitespace:
+        chunks = trim_lex(chunks)
+    return chunks
+
+
+def _find_mapped_position(buf, index, last_index, last_pos, encoding=None):
+    # count in windows, slices of a mapping are copies
+    lines = 0
+    for offset in range(last_index, index, 1 << 20):
+        lines += buf[offset:min(offset + (1 << 20), index)].count(b'\n')
+    if lines > 0:
+        start = buf.rfind(b'\n', last_index, index) + 1
+        column = 1
+    else:
+        start = last_index
+        column = last_pos[1]
+    if encoding is None:
+        column += index - start
+    else:
+        # columns count characters, not bytes
+        import codecs
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for offset in range(start, index, 1 << 20):
+            column += len(decoder.decode(
+                buf[offset:min(offset + (1 << 20), index)]))
+    return (last_pos[0] + lines, column)
+
+
 def find_position(string, index, last_index, last_pos):
     """
     Given a string and index, return (line, column)
@@ -1044,7 +3209,7 @@ parse.__doc__ = r"""
 
 
 def parse_expr(tokens, name, context=()):
-    if isinstance(tokens[0], basestring_):
+    if isinstance(tokens[0], _literal_types):
         return tokens[0], tokens[1:]
     expr, pos = tokens[0]
     expr = expr.strip()
@@ -1053,7 +3218,9 @@ def parse_expr(tokens, name, context=()):
             raise TemplateError(
                 'continue outside of for loop',
                 position=pos, name=name)
-        return (expr, pos), tokens[1:]
+        if expr == 'continue':
+            return ContinueNode(pos), tokens[1:]
+        return BreakNode(pos), tokens[1:]
     elif expr.startswith('if '):
         return parse_cond(tokens, name, context)
     elif (expr.startswith('elif ')
@@ -1077,9 +3244,14 @@ def parse_expr(tokens, name, context=()):
         return parse_inherit(tokens, name, context)
     elif expr.startswith('def '):
         return parse_def(tokens, name, context)
+    elif expr == 'flush':
+        return FlushNode(pos), tokens[1:]
     elif expr.startswith('#'):
-        return ('comment', pos, tokens[0][0]), tokens[1:]
-    return ('expr', pos, tokens[0][0]), tokens[1:]
+        return CommentNode(pos, tokens[0][0]), tokens[1:]
+    parts = tokens[0][0].split('|')
+    if len(parts) > 1 and parts[-1].strip() == 'safe':
+        return SafeNode(pos, '|'.join(parts[:-1])), tokens[1:]
+    return ExprNode(pos, tokens[0][0]), tokens[1:]
 
 
 def parse_cond(tokens, name, context):
@@ -1092,7 +3264,7 @@ def parse_cond(tokens, name, context):
                 'Missing {{endif}}',
                 position=start, name=name)
         if (isinstance(tokens[0], tuple) and tokens[0][0] == 'endif'):
-            return ('cond', start) + tuple(pieces), tokens[1:]
+            return CondNode(start, *pieces), tokens[1:]
         next_chunk, tokens = parse_one_cond(tokens, name, context)
         pieces.append(next_chunk)
 
@@ -1103,11 +3275,11 @@ def parse_one_cond(tokens, name, context):
     if first.endswith(':'):
         first = first[:-1]
     if first.startswith('if '):
-        part = ('if', pos, first[3:].lstrip(), content)
+        part = IfNode(pos, first[3:].lstrip(), content)
     elif first.startswith('elif '):
-        part = ('elif', pos, first[5:].lstrip(), content)
+        part = ElifNode(pos, first[5:].lstrip(), content)
     elif first == 'else':
-        part = ('else', pos, None, content)
+        part = ElseNode(pos, None, content)
     else:
         assert 0, "Unexpected token %r at %s" % (first, pos)
     while 1:
@@ -1153,7 +3325,7 @@ def parse_for(tokens, name, context):
                 'No {{endfor}}',
                 position=pos, name=name)
         if (isinstance(tokens[0], tuple) and tokens[0][0] == 'endfor'):
-            return ('for', pos, vars, expr, content), tokens[1:]
+            return ForNode(pos, vars, expr, content), tokens[1:]
         next_chunk, tokens = parse_expr(tokens, name, context)
         content.append(next_chunk)
 
@@ -1177,7 +3349,7 @@ def parse_default(tokens, name, context):
             "Not a valid variable name for {{default}}: %r"
             % var, position=pos, name=name)
     expr = parts[1].strip()
-    return ('default', pos, var, expr), tokens[1:]
+    return DefaultNode(pos, var, expr), tokens[1:]
 
 
 def parse_inherit(tokens, name, context):
@@ -1185,7 +3357,7 @@ def parse_inherit(tokens, name, context):
     #print("'{first}'".format(**locals()))
     assert first.startswith('inherit ')
     expr = first.split(None, 1)[1]
-    return ('inherit', pos, expr), tokens[1:]
+    return InheritNode(pos, expr), tokens[1:]
 
 
 def parse_def(tokens, name, context):
@@ -1204,24 +3376,1133 @@ def parse_def(tokens, name, context):
                 'Missing {{enddef}}',
                 position=start, name=name)
         if (isinstance(tokens[0], tuple) and tokens[0][0] == 'enddef'):
-            return ('def', start, func_name, sig, content), tokens[1:]
+            return DefNode(start, func_name, sig, content), tokens[1:]
         next_chunk, tokens = parse_expr(tokens, name, context)
         content.append(next_chunk)
 
 
+############################################################
+## Name analysis
+############################################################
+
+
+def expression_names(expr):
+    """
+    Return the free names read by a Python expression as a frozenset,
+    or None if the expression is not valid Python.
+
+        >>> sorted(expression_names('a.b + f(c, d=e)'))
+        ['a', 'c', 'e', 'f']
+        >>> sorted(expression_names('[x for x in y if x > z]'))
+        ['y', 'z']
+    """
+    import ast
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+        return None
+    loaded = set()
+    stored = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                stored.add(node.id)
+        elif isinstance(node, ast.arg):
+            stored.add(node.arg)
+    return frozenset(loaded - stored)
+
+
+def analyze_names(parsed):
+    """
+    Analyze a parse tree in document order and return a tuple
+    ``(required, bound)`` of frozensets.  ``required`` are the names read
+    before the template binds them, ``bound`` are the names bound by
+    ``for``, ``default`` and ``def``.
+
+        >>> required, bound = analyze_names(parse(
+        ...     '{{default a=b}}{{for x in y}}{{x}}{{a}}{{endfor}}'))
+        >>> sorted(required), sorted(bound)
+        (['b', 'y'], ['a', 'x'])
+    """
+    required = set()
+    bound = set()
+    defs = []
+    _collect_names(parsed, set(), required, bound, defs)
+    # def bodies run with the namespace of their call, which can bind any
+    # name the template binds
+    while defs:
+        _collect_names(defs.pop(), set(bound), required, bound, defs)
+    return frozenset(required), frozenset(bound)
+
+
+def _collect_names(codes, scope, required, bound, defs):
+    for code in codes:
+        if isinstance(code, _literal_types):
+            continue
+        name = code[0]
+        if name in ('expr', 'safe'):
+            for part in code[2].split('|'):
+                _require_names(part, scope, required)
+        elif name == 'for':
+            _require_names(code[3], scope, required)
+            scope.update(code[2])
+            bound.update(code[2])
+            _collect_names(code[4], scope, required, bound, defs)
+        elif name == 'cond':
+            for part in code[2:]:
+                if part[2] is not None:
+                    _require_names(part[2], scope, required)
+                _collect_names(part[3], scope, required, bound, defs)
+        elif name == 'default':
+            _require_names(code[3], scope, required)
+            scope.add(code[2])
+            bound.add(code[2])
+        elif name == 'inherit':
+            _require_names(code[2], scope, required)
+        elif name == 'def':
+            scope.add(code[2])
+            bound.add(code[2])
+            defs.append(code[4])
+
+
+def _require_names(expr, scope, required):
+    names = expression_names(expr)
+    if names:
+        required.update(names - scope)
+
+
+############################################################
+## Partial evaluation
+############################################################
+
+
+_residual = object()
+
+
+class _Specializer(object):
+    """
+    Partial evaluation of a parse tree for ``Template.specialize``.
+
+    ``env`` maps the names known while specializing to their value, or to
+    ``_residual`` for names bound when the template is rendered.
+    Unrolled ``{{for}}`` loops are undone (``no_unroll``) when the
+    residual template still reads their variables.
+    """
+
+    def __init__(self, template, namespace, no_unroll):
+        self.template = template
+        self.namespace = namespace
+        self.no_unroll = no_unroll
+        self.bound = analyze_names(template._parsed)[1]
+        self.unrolled = {}
+
+    def specialize(self):
+        env = dict(self.namespace)
+        env['__template_name__'] = self.template.name
+        return self.codes(self.template._parsed, env)
+
+    def conflicts(self, parsed):
+        """
+        The positions of unrolled loops whose variables are read by the
+        residual parse tree.
+        """
+        required = analyze_names(parsed)[0]
+        return set(pos for pos, vars in self.unrolled.items()
+                   if required.intersection(vars))
+
+    def codes(self, codes, env):
+        result = []
+        for code in codes:
+            if isinstance(code, _literal_types):
+                result.append(code)
+            else:
+                result.extend(
+                    getattr(self, 'specialize_' + code[0])(code, env))
+        # join the text of evaluated nodes
+        merged = []
+        for code in result:
+            if (merged and isinstance(code, basestring_)
+                    and type(code) is type(merged[-1])):
+                merged[-1] += code
+            elif code:
+                merged.append(code)
+        return merged
+
+    def static(self, expr, env):
+        names = expression_names(expr)
+        if names is None:
+            return False
+        for name in names:
+            # builtins and the default namespace can be replaced by the
+            # names given when rendering
+            if (env.get(name, _residual) is _residual
+                    and name not in ('True', 'False', 'None')):
+                return False
+        return True
+
+    def bind(self, names, env):
+        for name in names:
+            env[name] = _residual
+
+    def specialize_expr(self, code, env):
+        for part in code[2].split('|'):
+            if not self.static(part, env):
+                return [code]
+        out = []
+        try:
+            code.interpret(self.template, env, out, {})
+        except Exception:
+            # left for the render to report
+            return [code]
+        return out
+
+    specialize_safe = specialize_expr
+
+    def specialize_comment(self, code, env):
+        return []
+
+    def specialize_continue(self, code, env):
+        return [code]
+
+    specialize_break = specialize_inherit = specialize_continue
+    specialize_flush = specialize_continue
+
+    def specialize_default(self, code, env):
+        if code[2] in env and env[code[2]] is not _residual:
+            # always bound, the default is never used
+            return []
+        self.bind([code[2]], env)
+        return [code]
+
+    def specialize_def(self, code, env):
+        # the body sees the namespace of the call
+        body_env = dict(env)
+        self.bind(self.bound, body_env)
+        self.bind([code[2]], env)
+        return [DefNode(code[1], code[2], code[3],
+                        self.codes(code[4], body_env))]
+
+    def specialize_cond(self, code, env):
+        kept = []
+        bound = set()
+        for part in code[2:]:
+            if part[0] == 'else':
+                static = value = True
+            else:
+                static = self.static(part[2], env)
+                if static:
+                    try:
+                        value = part.test(self.template, env)
+                    except Exception:
+                        static = False
+            if static and not value:
+                continue
+            if static and not kept:
+                return self.codes(part[3], env)
+            bound.update(analyze_names(part[3])[1])
+            content = self.codes(part[3], dict(env))
+            if static:
+                kept.append(ElseNode(part[1], None, content))
+                break
+            elif kept:
+                kept.append(ElifNode(part[1], part[2], content))
+            else:
+                kept.append(IfNode(part[1], part[2], content))
+        self.bind(bound, env)
+        if not kept:
+            return []
+        return [CondNode(code[1], *kept)]
+
+    def specialize_for(self, code, env):
+        vars, content = code[2], code[4]
+        items = self.unroll_items(code, env)
+        if items is not None:
+            self.unrolled[code[1]] = vars
+            result = []
+            for item in items:
+                env.update(zip(vars, item))
+                result.extend(self.codes(content, env))
+            return result
+        body_env = dict(env)
+        self.bind(vars, body_env)
+        body = self.codes(content, body_env)
+        self.bind(vars, env)
+        self.bind(analyze_names(content)[1], env)
+        return [ForNode(code[1], vars, code[3], body)]
+
+    def unroll_items(self, code, env):
+        """
+        The items of a loop that can be unrolled as tuples of the values
+        of the loop variables, or None.
+        """
+        vars = code[2]
+        if (code[1] in self.no_unroll or not self.static(code[3], env)
+                or _loop_statements.intersection(_directives(code[4]))
+                or any(var in self.namespace for var in vars)):
+            return None
+        try:
+            items = list(self.template._eval(code[3], env, code[1]))
+            if len(vars) == 1:
+                return [(item,) for item in items]
+            items = [tuple(item) for item in items]
+        except Exception:
+            return None
+        for item in items:
+            if len(item) != len(vars):
+                return None
+        return items
+
+
+############################################################
+## Sandboxed expressions
+############################################################
+
+
+class Sandbox(object):
+    """
+    Evaluate template expressions without access to arbitrary Python.
+
+    Expressions are checked against a whitelist when the template is
+    created and compiled into closures: names, constants, attribute
+    access (not to names starting with ``_``), subscripts, arithmetic
+    (no ``**`` or shifts), comparisons, boolean operators, conditional
+    expressions, literal tuples, lists and dicts, and calls of
+    registered functions.  Functions are registered with ``functions``,
+    the callables of a template's ``default_namespace`` and
+    ``namespace`` are registered as well.  Functions of ``{{def}}``
+    blocks can be called too.  Sequences built with ``*``, ``+`` and
+    ``range`` are limited to ``max_size`` items and ``sum`` only adds
+    numbers.  This does not bound the memory or time a render takes,
+    registered functions and methods of the values can still build large
+    results (see ``RenderLimits`` for the output and the time).
+
+    :param dict functions: Functions expressions may call.
+    :param bool builtins: Register a small set of harmless builtins
+                          (``len``, ``str``, ``sorted``...).
+    """
+
+    max_size = 1000000
+
+    safe_builtins = (
+        'abs', 'bool', 'dict', 'enumerate', 'float', 'int', 'len', 'list',
+        'max', 'min', 'range', 'reversed', 'round', 'sorted', 'str', 'sum',
+        'tuple', 'zip')
+    # attributes giving access to formatting, the type system, frames
+    # (and their globals and builtins) or function internals
+    unsafe_attributes = frozenset([
+        'format', 'format_map', 'mro',
+        'gi_frame', 'gi_code', 'gi_yieldfrom', 'cr_frame', 'cr_code',
+        'cr_await', 'ag_frame', 'ag_code', 'ag_await',
+        'f_globals', 'f_locals', 'f_builtins', 'f_back', 'f_code',
+        'tb_frame', 'tb_next',
+        'func_globals', 'func_code', 'func_closure', 'func_defaults',
+        'func_dict', 'im_func', 'im_self', 'im_class'])
+
+    def __init__(self, functions=None, builtins=True):
+        self.functions = {}
+        if builtins:
+            for name in self.safe_builtins:
+                self.functions[name] = getattr(_builtins, name)
+            self.functions['range'] = self._range
+            self.functions['sum'] = self._sum
+        if functions:
+            self.functions.update(functions)
+
+    def __repr__(self):
+        return '<%s (%i functions)>' % (
+            self.__class__.__name__, len(self.functions))
+
+    def compile(self, expr, functions=None, filter=False, names=None):
+        """
+        Check expr and return a function evaluating it for a namespace.
+        Raises ``ValueError`` if it uses anything not allowed.  A
+        ``filter`` has to be the name of a registered function or a call.
+        Values of ``names`` are used for names missing in the namespace.
+        """
+        import ast
+        if functions is None:
+            functions = self.functions
+        try:
+            tree = ast.parse(expr.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError('invalid syntax in expression: %s' % expr)
+        if filter and not (
+                isinstance(tree.body, ast.Call)
+                or isinstance(tree.body, ast.Name)
+                and tree.body.id in functions):
+            raise ValueError('%s is not a registered function' % expr.strip())
+        return _SandboxCompiler(self, functions, names).compile(tree.body)
+
+    def evaluate(self, expr, ns=None):
+        """
+        Evaluate an expression in the sandbox.
+        """
+        return self.compile(expr)(ns or {})
+
+    def _check_size(self, size):
+        if size > self.max_size:
+            raise ValueError('sequences longer than %i items are not allowed'
+                             % self.max_size)
+
+    def _range(self, *args):
+        self._check_size(len(_xrange(*args)))
+        return range(*args)
+
+    def _sum(self, iterable, start=0):
+        if isinstance(start, _sandbox_sequences):
+            raise ValueError('sum() of sequences is not allowed')
+        return sum(iterable, start)
+
+    def _add(self, a, b):
+        if (isinstance(a, _sandbox_sequences)
+                and isinstance(b, _sandbox_sequences)):
+            self._check_size(len(a) + len(b))
+        return a + b
+
+    def _multiply(self, a, b):
+        if isinstance(a, _sandbox_sequences) and isinstance(b, _integers):
+            self._check_size(len(a) * b)
+        elif isinstance(b, _sandbox_sequences) and isinstance(a, _integers):
+            self._check_size(len(b) * a)
+        return a * b
+
+
+def _unsafe_types():
+    import types
+    return (types.FrameType, types.CodeType, types.TracebackType)
+
+
+# objects a sandbox reads no attributes of
+_sandbox_unsafe_types = _unsafe_types()
+# sequences a sandbox limits the repetition of
+_sandbox_sequences = (bytes, type(u''), list, tuple)
+_integers = (int, type(1 << 64))
+_xrange = getattr(_builtins, 'xrange', range)
+
+
+class _SandboxCompiler(object):
+
+    def __init__(self, sandbox, functions, names=None):
+        import operator
+        self.sandbox = sandbox
+        self.functions = functions
+        self.names = names or {}
+        self.operator = operator
+
+    def compile(self, node):
+        method = getattr(self, 'compile_' + node.__class__.__name__, None)
+        if method is None:
+            raise ValueError('%s is not allowed in expressions'
+                             % node.__class__.__name__)
+        return method(node)
+
+    def constant(self, value):
+        return lambda ns: value
+
+    def compile_Constant(self, node):
+        return self.constant(node.value)
+
+    def compile_Num(self, node):
+        return self.constant(node.n)
+
+    def compile_Str(self, node):
+        return self.constant(node.s)
+
+    compile_Bytes = compile_Str
+
+    def compile_NameConstant(self, node):
+        return self.constant(node.value)
+
+    def compile_Name(self, node):
+        name = node.id
+        if name in ('True', 'False', 'None'):
+            return self.constant(eval(name))
+        functions = self.functions
+        names = self.names
+
+        def lookup(ns):
+            try:
+                return ns[name]
+            except KeyError:
+                try:
+                    return functions[name]
+                except KeyError:
+                    try:
+                        return names[name]
+                    except KeyError:
+                        raise NameError('name %r is not defined' % name)
+        return lookup
+
+    def compile_Attribute(self, node):
+        attr = node.attr
+        if attr.startswith('_') or attr in self.sandbox.unsafe_attributes:
+            raise ValueError('access to attribute %r is not allowed' % attr)
+        value = self.compile(node.value)
+
+        def get(ns):
+            obj = value(ns)
+            if isinstance(obj, _sandbox_unsafe_types):
+                raise ValueError('access to attribute %r of %s objects is '
+                                 'not allowed' % (attr, type(obj).__name__))
+            return getattr(obj, attr)
+        return get
+
+    def compile_Subscript(self, node):
+        value = self.compile(node.value)
+        index = self.compile(node.slice)
+        return lambda ns: value(ns)[index(ns)]
+
+    def compile_Index(self, node):
+        return self.compile(node.value)
+
+    def compile_Slice(self, node):
+        parts = [self.compile(part) if part is not None
+                 else self.constant(None)
+                 for part in (node.lower, node.upper, node.step)]
+        lower, upper, step = parts
+        return lambda ns: slice(lower(ns), upper(ns), step(ns))
+
+    def compile_Tuple(self, node):
+        items = [self.compile(item) for item in node.elts]
+        return lambda ns: tuple([item(ns) for item in items])
+
+    def compile_List(self, node):
+        items = [self.compile(item) for item in node.elts]
+        return lambda ns: [item(ns) for item in items]
+
+    def compile_Dict(self, node):
+        if None in node.keys:
+            raise ValueError('** is not allowed in expressions')
+        items = [(self.compile(key), self.compile(value))
+                 for key, value in zip(node.keys, node.values)]
+        return lambda ns: dict([(key(ns), value(ns))
+                                for key, value in items])
+
+    def operation(self, op, table):
+        name = table.get(op.__class__.__name__)
+        if name is None:
+            raise ValueError('%s is not allowed in expressions'
+                             % op.__class__.__name__)
+        if callable(name):
+            return name
+        return getattr(self.operator, name)
+
+    def compile_BinOp(self, node):
+        op = self.operation(node.op, _sandbox_binary_ops)
+        if op is self.operator.mul:
+            op = self.sandbox._multiply
+        elif op is self.operator.add:
+            op = self.sandbox._add
+        left = self.compile(node.left)
+        right = self.compile(node.right)
+        return lambda ns: op(left(ns), right(ns))
+
+    def compile_UnaryOp(self, node):
+        op = self.operation(node.op, _sandbox_unary_ops)
+        operand = self.compile(node.operand)
+        return lambda ns: op(operand(ns))
+
+    def compile_BoolOp(self, node):
+        values = [self.compile(value) for value in node.values]
+        if node.op.__class__.__name__ == 'And':
+            def evaluate(ns):
+                for value in values:
+                    result = value(ns)
+                    if not result:
+                        break
+                return result
+        else:
+            def evaluate(ns):
+                for value in values:
+                    result = value(ns)
+                    if result:
+                        break
+                return result
+        return evaluate
+
+    def compile_Compare(self, node):
+        left = self.compile(node.left)
+        ops = [self.operation(op, _sandbox_compare_ops) for op in node.ops]
+        rights = [self.compile(right) for right in node.comparators]
+        if len(ops) == 1:
+            op, right = ops[0], rights[0]
+            return lambda ns: op(left(ns), right(ns))
+        comparisons = list(zip(ops, rights))
+
+        def evaluate(ns):
+            value = left(ns)
+            for op, right in comparisons:
+                other = right(ns)
+                if not op(value, other):
+                    return False
+                value = other
+            return True
+        return evaluate
+
+    def compile_IfExp(self, node):
+        test = self.compile(node.test)
+        body = self.compile(node.body)
+        orelse = self.compile(node.orelse)
+        return lambda ns: body(ns) if test(ns) else orelse(ns)
+
+    def compile_Call(self, node):
+        if [arg for arg in node.args if arg.__class__.__name__ == 'Starred'] \
+                or [kw for kw in node.keywords if kw.arg is None] \
+                or getattr(node, 'starargs', None) \
+                or getattr(node, 'kwargs', None):
+            raise ValueError('* and ** are not allowed in calls')
+        args = [self.compile(arg) for arg in node.args]
+        keywords = [(kw.arg, self.compile(kw.value)) for kw in node.keywords]
+        if (node.func.__class__.__name__ == 'Name'
+                and node.func.id in self.functions):
+            func = self.constant(self.functions[node.func.id])
+        else:
+            # only {{def}} functions are found at render time
+            func = self._template_function(self.compile(node.func))
+
+        def call(ns):
+            return func(ns)(*[arg(ns) for arg in args],
+                            **dict([(name, value(ns))
+                                    for name, value in keywords]))
+        return call
+
+    def _template_function(self, func):
+        def lookup(ns):
+            value = func(ns)
+            if not isinstance(value, TemplateDef):
+                raise TypeError('%r is not a registered function' % (value,))
+            return value
+        return lookup
+
+
+_sandbox_binary_ops = {
+    'Add': 'add', 'Sub': 'sub', 'Mult': 'mul', 'Div': 'truediv',
+    'FloorDiv': 'floordiv', 'Mod': 'mod', 'BitAnd': 'and_',
+    'BitOr': 'or_', 'BitXor': 'xor',
+}
+_sandbox_unary_ops = {
+    'Not': 'not_', 'USub': 'neg', 'UAdd': 'pos', 'Invert': 'invert',
+}
+_sandbox_compare_ops = {
+    'Eq': 'eq', 'NotEq': 'ne', 'Lt': 'lt', 'LtE': 'le', 'Gt': 'gt',
+    'GtE': 'ge', 'Is': 'is_', 'IsNot': 'is_not',
+    'In': lambda a, b: a in b, 'NotIn': lambda a, b: a not in b,
+}
+
+
+############################################################
+## Compilation
+############################################################
+
+
+class _CompileError(Exception):
+    pass
+
+
+_loop_statements = frozenset(['continue', 'break'])
+
+
+class TemplateCompiler(object):
+    """
+    Compile a parsed template into the source of a Python render function.
+
+    Every name the template reads or binds becomes a local variable of the
+    generated function, bound once per render from the namespace (or the
+    default namespace and builtins).  ``for`` targets become the targets of
+    native ``for`` loops and ``{{def}}`` blocks become closures.
+
+    ``compile()`` returns the source and a dict mapping generated source
+    lines to template positions, used to report errors.  ``_CompileError``
+    is raised for templates the compiler does not support; those are
+    interpreted instead.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.lines = []
+        self.positions = {}
+        self.indent = 0
+        self.pos = None
+        self.def_count = 0
+        self.literals = []
+        # the output of some expressions can be known when compiling
+        convert = type(template)._convert
+        self.static_output = template._unicode and (
+            convert is Template._convert or convert is HTMLTemplate._convert)
+
+    def compile(self):
+        parsed = self.template._parsed
+        assigned, defaults = self.scope_names(parsed)
+        loaded = set()
+        self.loaded_names(parsed, loaded)
+        self.check_scopes(parsed, [assigned])
+        self.write('def _t_render(_t_self, _t_ns, _t_defs):')
+        self.indent += 1
+        self.write('_t_G = _t_self._globals()')
+        self.write('_t_L = _t_self._mapped_literals')
+        self.write('_t_repr = _t_self._convert')
+        if self.template.default_filter is not None:
+            self.write('_t_filter = _t_self.default_filter')
+        if 'safe' in _directives(parsed):
+            self.write('_t_safe = _t_self._convert_safe')
+        if self.static_output:
+            self.write('_t_number = _t_self._convert_number')
+            if isinstance(self.template, HTMLTemplate):
+                self.write('_t_markup = _t_self._convert_markup')
+        self.write('_t_out = []')
+        if self.template.limits is not None:
+            self.write('_t_budget = _t_self._budget()')
+            self.write('_t_append = _t_budget.counting(_t_out.append)')
+        else:
+            self.write('_t_append = _t_out.append')
+        self.write_prelude(loaded | assigned, defaults)
+        self.write_codes(parsed, 0)
+        if assigned:
+            # make defaults, loop variables and defs visible to an
+            # inheriting parent template as the interpreter does
+            self.write('_t_locals = locals()')
+            self.write('for _t_name in %r:' % (tuple(sorted(assigned)),))
+            self.write('    if _t_name in _t_locals:')
+            self.write('        _t_ns[_t_name] = _t_locals[_t_name]')
+        self.write('return _t_out')
+        self.indent -= 1
+        return '\n'.join(self.lines) + '\n', self.positions
+
+    def write(self, text):
+        lineno = len(self.lines) + 1
+        for i in range(text.count('\n') + 1):
+            self.positions[lineno + i] = self.pos
+        self.lines.append('    ' * self.indent + text)
+
+    def write_prelude(self, names, defaults):
+        global_ns = self.template._globals()
+        for name in sorted(names):
+            if name in global_ns and name not in defaults:
+                self.write('%s = _t_ns[%r] if %r in _t_ns else _t_G[%r]'
+                           % (name, name, name, name))
+            else:
+                self.write('if %r in _t_ns: %s = _t_ns[%r]'
+                           % (name, name, name))
+
+    def write_codes(self, codes, loops):
+        start = len(self.lines)
+        for code in codes:
+            if isinstance(code, basestring_):
+                if code:
+                    self.write('_t_append(%r)' % (code,))
+            elif isinstance(code, MappedText):
+                self.literals.append(code)
+                self.write('_t_append(_t_L[%i].text())'
+                           % (len(self.literals) - 1))
+            else:
+                self.pos = code[1]
+                getattr(self, 'write_' + code[0])(code, loops)
+        if len(self.lines) == start:
+            self.write('pass')
+
+    def write_continue(self, code, loops):
+        if not loops:
+            raise _CompileError('%s outside of a loop' % code[0])
+        self.write(code[0])
+
+    write_break = write_continue
+
+    def write_comment(self, code, loops):
+        pass
+
+    # the output of compiled code is a list
+    write_flush = write_comment
+
+    def write_expr(self, code, loops):
+        parts = code[2].split('|')
+        value = self.expression(parts[0])
+        if len(parts) == 1:
+            if self.template.default_filter is not None:
+                value = '_t_filter(%s)' % value
+                self.write('_t_append(_t_repr(%s))' % value)
+                return
+            kind = self.output_kind(parts[0])
+            if isinstance(kind, tuple):
+                self.write('_t_append(%r)'
+                           % (self.template._convert(kind[1]),))
+            else:
+                self.write('_t_append(_t_%s(%s))' % (kind, value))
+            return
+        self.write('_t_value = %s' % value)
+        for part in parts[1:]:
+            self.write('_t_value = %s(_t_value)' % self.expression(part))
+        self.write('_t_append(_t_repr(_t_value))')
+
+    def write_safe(self, code, loops):
+        parts = code[2].split('|')
+        self.write('_t_value = %s' % self.expression(parts[0]))
+        for part in parts[1:]:
+            self.write('_t_value = %s(_t_value)' % self.expression(part))
+        self.write('_t_append(_t_safe(_t_value))')
+
+    def output_kind(self, expr):
+        """
+        Return how to convert the value of an expression: ``repr`` (the
+        template's ``_convert``), ``number`` for expressions usually
+        giving numbers, ``markup`` for ``html()`` and ``attr()`` calls of
+        HTML templates or ``('constant', value)`` for literals.
+        """
+        if not self.static_output:
+            return 'repr'
+        import ast
+        node = ast.parse(expr.strip(), mode='eval').body
+        if node.__class__.__name__ in ('Constant', 'Num', 'Str'):
+            value = getattr(node, 'value', getattr(node, 'n', None))
+            if node.__class__.__name__ == 'Str':
+                value = node.s
+            if isinstance(value, (unicode, int, float)):
+                return ('constant', value)
+        elif isinstance(node, ast.Attribute):
+            if node.attr in ('number', 'index', 'length'):
+                return 'number'
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id == 'len':
+                return 'number'
+            if (node.func.id in ('html', 'attr')
+                    and isinstance(self.template, HTMLTemplate)):
+                return 'markup'
+        return 'repr'
+
+    def write_for(self, code, loops):
+        vars = code[2]
+        for var in vars:
+            self.check_name(var)
+        expr = self.expression(code[3])
+        spec = self.template._column_spec(code)
+        if spec:
+            self.write('_t_text, _t_rows = _t_self._render_columns(%r, %s)'
+                       % (spec, expr))
+            self.write('if _t_text is not None:')
+            self.write('    _t_append(_t_text)')
+            self.write('    if len(_t_rows):')
+            self.write('        %s = _t_rows[-1]' % vars[0])
+            self.write('else:')
+            self.indent += 1
+            expr = '_t_rows'
+        if self.template.limits is not None:
+            expr = '_t_budget.iterate(%s)' % expr
+        self.write('for %s in %s:' % (', '.join(vars), expr))
+        self.indent += 1
+        self.write_codes(code[4], loops + 1)
+        self.indent -= 1
+        if spec:
+            self.indent -= 1
+
+    def write_cond(self, code, loops):
+        for part in code[2:]:
+            self.pos = part[1]
+            if part[0] == 'else':
+                self.write('else:')
+            else:
+                self.write('%s %s:' % (part[0], self.expression(part[2])))
+            self.indent += 1
+            self.write_codes(part[3], loops)
+            self.indent -= 1
+
+    def write_default(self, code, loops):
+        var = code[2]
+        self.check_name(var)
+        self.write('try:')
+        self.write('    %s' % var)
+        self.write('except NameError:')
+        self.write('    %s = %s' % (var, self.expression(code[3])))
+
+    def write_inherit(self, code, loops):
+        self.write("_t_defs['__inherit__'] = %s" % self.expression(code[2]))
+
+    def write_def(self, code, loops):
+        name, body = code[2], code[4]
+        self.check_name(name)
+        assigned, defaults = self.scope_names(body)
+        self.def_count += 1
+        func_name = '_t_def_%i' % self.def_count
+        pos = code[1]
+        self.write('def %s():' % func_name)
+        self.indent += 1
+        self.write('_t_defs = {}')
+        self.write('_t_out = []')
+        self.write('_t_append = _t_out.append')
+        self.write_prelude(assigned, defaults)
+        self.write_codes(body, 0)
+        self.write('return _t_out')
+        self.indent -= 1
+        self.pos = pos
+        self.write('%s = _t_defs[%r] = _t_CompiledDef(_t_self, %r, %s, None, %r)'
+                   % (name, name, name, func_name, pos))
+
+    def expression(self, expr):
+        import ast
+        expr = expr.strip()
+        try:
+            tree = ast.parse(expr, mode='eval')
+        except SyntaxError:
+            raise _CompileError('invalid syntax in expression: %s' % expr)
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Yield, ast.YieldFrom, ast.Await,
+                                 getattr(ast, 'NamedExpr', ast.Yield))):
+                raise _CompileError('unsupported expression: %s' % expr)
+            if isinstance(node, ast.Name) and node.id.startswith('_t_'):
+                raise _CompileError('reserved name: %s' % node.id)
+        if '#' in expr:
+            return '(%s\n)' % expr
+        return '(%s)' % expr
+
+    def check_name(self, name):
+        import keyword
+        if (not var_re.search(name) or keyword.iskeyword(name)
+                or name.startswith('_t_')):
+            raise _CompileError('not a valid name: %r' % name)
+
+    def scope_names(self, codes, assigned=None, defaults=None):
+        """
+        Return the names bound in one function scope and the subset of
+        those bound by ``{{default}}``, not descending into ``def`` bodies.
+        """
+        if assigned is None:
+            assigned, defaults = set(), set()
+        for code in codes:
+            if isinstance(code, _literal_types):
+                continue
+            name = code[0]
+            if name == 'for':
+                assigned.update(code[2])
+                self.scope_names(code[4], assigned, defaults)
+            elif name == 'cond':
+                for part in code[2:]:
+                    self.scope_names(part[3], assigned, defaults)
+            elif name == 'default':
+                assigned.add(code[2])
+                defaults.add(code[2])
+            elif name == 'def':
+                assigned.add(code[2])
+        return assigned, defaults
+
+    def loaded_names(self, codes, loaded):
+        required, bound = analyze_names(codes)
+        loaded.update(required)
+        loaded.update(bound)
+
+    def check_scopes(self, codes, enclosing):
+        """
+        A def body runs on a copy of the namespace, so a name it binds
+        shadows the enclosing value.  Closures cannot express a name that
+        is rebound in both scopes, such templates are not compiled.
+        """
+        for code in codes:
+            if isinstance(code, _literal_types):
+                continue
+            name = code[0]
+            if name == 'for':
+                self.check_scopes(code[4], enclosing)
+            elif name == 'cond':
+                for part in code[2:]:
+                    self.check_scopes(part[3], enclosing)
+            elif name == 'def':
+                assigned, defaults = self.scope_names(code[4])
+                for names in enclosing:
+                    if assigned & names:
+                        raise _CompileError(
+                            'def %s rebinds %s' % (
+                                code[2], ', '.join(sorted(assigned & names))))
+                self.check_scopes(code[4], enclosing + [assigned])
+
+
+############################################################
+## Column rendering
+############################################################
+
+_text_types = frozenset([unicode])
+_number_types = frozenset([int, float, bool])
+_plain_types = _text_types | _number_types
+
+
+def column_spec(code):
+    """
+    Recognize a ``for`` loop whose body is only literal text and
+    expressions reading the loop variable itself, its attributes or items
+    with constant keys.  Returns ``(format, getters)``, a %-format string
+    with one ``%s`` per cell and one tuple of ``('.', attr)`` /
+    ``('[]', key)`` steps per cell, or None.
+
+        >>> column_spec(parse(
+        ...     '{{for r in rows}}<td>{{r.a}}</td><td>{{r["b"]}}%{{endfor}}'
+        ...     )[0])
+        ('<td>%s</td><td>%s%%', ((('.', 'a'),), (('[]', 'b'),)))
+    """
+    vars, content = code[2], code[4]
+    if len(vars) != 1:
+        return None
+    fmt = []
+    getters = []
+    for item in content:
+        if isinstance(item, unicode):
+            fmt.append(item.replace('%', '%%'))
+        elif not isinstance(item, tuple):
+            return None
+        elif item[0] == 'comment':
+            continue
+        elif item[0] == 'expr' and '|' not in item[2]:
+            steps = _getter_steps(item[2], vars[0])
+            if steps is None:
+                return None
+            fmt.append('%s')
+            getters.append(steps)
+        else:
+            return None
+    return ''.join(fmt), tuple(getters)
+
+
+def _getter_steps(expr, var):
+    import ast
+    try:
+        node = ast.parse(expr.strip(), mode='eval').body
+    except SyntaxError:
+        return None
+    steps = []
+    while not (isinstance(node, ast.Name) and node.id == var):
+        if isinstance(node, ast.Attribute):
+            steps.append(('.', node.attr))
+        elif isinstance(node, ast.Subscript):
+            key = node.slice
+            if isinstance(key, getattr(ast, 'Index', ())):
+                key = key.value
+            try:
+                key = ast.literal_eval(key)
+            except ValueError:
+                return None
+            if not isinstance(key, (basestring_, int)):
+                return None
+            steps.append(('[]', key))
+        else:
+            return None
+        node = node.value
+    return tuple(reversed(steps))
+
+
+_column_getters = {}
+
+
+def _column_getter(steps):
+    getter = _column_getters.get(steps)
+    if getter is None:
+        from operator import attrgetter, itemgetter
+        if all(kind == '.' for kind, key in steps):
+            getter = attrgetter('.'.join(key for kind, key in steps))
+        elif len(steps) == 1:
+            getter = itemgetter(steps[0][1])
+        else:
+            def getter(value):
+                for kind, key in steps:
+                    if kind == '.':
+                        value = getattr(value, key)
+                    else:
+                        value = value[key]
+                return value
+        _column_getters[steps] = getter
+    return getter
+
+
+def _table_column(rows, steps, names):
+    """
+    Extract one column from rows; NumPy structured and record arrays
+    (``names`` is their ``dtype.names``) are sliced by field instead of
+    row by row.
+    """
+    if not steps:
+        return list(rows)
+    if names and len(steps) == 1 and steps[0][1] in names:
+        return rows[steps[0][1]].tolist()
+    return list(map(_column_getter(steps), rows))
+
+
+_unbound_re = re.compile(r"(?:local|free) variable '(\w+)'")
+
+
+def _annotate_error(e, tb):
+    """
+    Add template positions to an exception raised while rendering, the
+    innermost template frame first.  Positions come from the expression
+    evaluations of the interpreter (``_eval`` and ``_repr`` frames) and
+    the line numbers of compiled render code.  A nested render annotates
+    its own frames, so the walk stops there.
+    """
+    positions = []
+    tb = tb.tb_next
+    while tb is not None:
+        frame = tb.tb_frame
+        code = frame.f_code
+        if code in _render_codes:
+            break
+        if code in _expression_codes:
+            positions.append((frame.f_locals['pos'],
+                              frame.f_locals['self'].name))
+            tb = tb.tb_next
+            continue
+        info = frame.f_globals.get('__tempita_template__')
+        if info is not None and code.co_name.startswith('_t_'):
+            name, lines = info
+            pos = lines.get(tb.tb_lineno)
+            if pos is not None:
+                positions.append((pos, name))
+        tb = tb.tb_next
+    if not positions:
+        return
+    if isinstance(e, TemplateLimitError):
+        if e.position is None:
+            e.position, e.name = positions[-1]
+        return
+    if getattr(e, 'args', None):
+        arg0 = e.args[0]
+    else:
+        arg0 = coerce_text(e)
+    if isinstance(e, NameError):
+        match = _unbound_re.search(coerce_text(arg0))
+        if match:
+            arg0 = "name '%s' is not defined" % match.group(1)
+    for pos, name in reversed(positions):
+        arg0 = _add_line_info(arg0, pos, name)
+    e.args = (arg0,)
+
+
+_render_codes = frozenset([Template._interpret.__code__,
+                           Template._interpret_compiled.__code__,
+                           Template._stream.__code__,
+                           Template._render_to.__code__,
+                           Template._render_def.__code__])
+_expression_codes = frozenset([Template._eval.__code__,
+                               Template._repr.__code__])
+
+
 _fill_command_usage = """\
 %prog [OPTIONS] TEMPLATE arg=value
+%prog [OPTIONS] --batch MANIFEST arg=value
 
 Use py:arg=value to set a Python value; otherwise all values are
-strings.
+strings.  With --safe templates and py: values can only use the
+expressions allowed by a Sandbox.
+
+With --batch all jobs of a manifest are rendered in one process.  The
+manifest has one JSON object per line with the keys "template" and
+"output" (file names) and optionally "vars" (an object with the
+variables of this job, added to the ones given as arguments), "data"
+(JSON files with more variables) and "html" (true or false, overriding
+--html).  Use - to read it from stdin.
+
+With --watch the outputs are rendered again whenever a template, an
+inherited template, a data file or the manifest changes.  A single
+TEMPLATE needs --output to be watched.
 """
 
 
 def fill_command(args=None):
-    import sys
     import optparse
-    import pkg_resources
-    import os
     if args is None:
         args = sys.argv[1:]
     parser = optparse.OptionParser(
@@ -1242,12 +4523,48 @@ def fill_command(args=None):
         dest='use_env',
         action='store_true',
         help="Put the environment in as top-level variables")
+    parser.add_option(
+        '--encoding',
+        dest='encoding',
+        default='utf8',
+        help="Encoding of templates and output (default utf8)")
+    parser.add_option(
+        '--batch',
+        dest='batch',
+        metavar="MANIFEST",
+        help="Render all jobs of a JSON lines manifest")
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs',
+        type='int',
+        default=1,
+        metavar="N",
+        help="Render batch jobs in N processes (default 1)")
+    parser.add_option(
+        '--watch',
+        dest='watch',
+        action='store_true',
+        help="Watch the inputs and render changed outputs again")
+    parser.add_option(
+        '--interval',
+        dest='interval',
+        type='float',
+        default=1.0,
+        metavar="SECONDS",
+        help="Seconds between checks for changes with --watch")
+    parser.add_option(
+        '--safe',
+        dest='safe',
+        action='store_true',
+        help="Evaluate expressions and py: values in a sandbox")
     options, args = parser.parse_args(args)
-    if len(args) < 1:
-        print('You must give a template filename')
-        sys.exit(2)
-    template_name = args[0]
-    args = args[1:]
+    sandbox = Sandbox() if options.safe else None
+    if not options.batch:
+        if len(args) < 1:
+            print('You must give a template filename')
+            sys.exit(2)
+        template_name = args[0]
+        args = args[1:]
     vars = {}
     if options.use_env:
         vars.update(os.environ)
@@ -1257,27 +4574,285 @@ def fill_command(args=None):
             sys.exit(2)
         name, value = value.split('=', 1)
         if name.startswith('py:'):
-            name = name[:3]
-            value = eval(value)
+            name = name[3:]
+            if sandbox is not None:
+                value = sandbox.evaluate(value)
+            else:
+                value = eval(value)
         vars[name] = value
+    if options.watch:
+        if options.batch:
+            watcher = FillWatcher(options.batch, vars, options.use_html,
+                                  options.encoding, sandbox)
+        elif options.output and template_name != '-':
+            watcher = FillWatcher(None, vars, options.use_html,
+                                  options.encoding, sandbox)
+            watcher.jobs = {options.output: {'template': template_name,
+                                             'output': options.output}}
+        else:
+            print('--watch needs --batch or a template file and --output')
+            sys.exit(2)
+        watcher.run(options.interval)
+        return
+    if options.batch:
+        jobs = _read_manifest(options.batch)
+        _fill_batch(jobs, vars, options.use_html, options.encoding,
+                    options.jobs, sandbox)
+        return
     if template_name == '-':
         template_content = sys.stdin.read()
         template_name = '<stdin>'
     else:
         with open(template_name, 'rb') as f:
             template_content = f.read()
+        if options.encoding:
+            template_content = template_content.decode(options.encoding)
     if options.use_html:
         TemplateClass = HTMLTemplate
     else:
         TemplateClass = Template
-    template = TemplateClass(template_content, name=template_name)
+    template = TemplateClass(template_content, name=template_name,
+                             sandbox=sandbox)
     result = template.substitute(vars)
     if options.output:
-        with open(options.output, 'wb') as f:
-            f.write(result)
+        _write_output(options.output, result, options.encoding)
     else:
         sys.stdout.write(result)
 
 
+def _read_manifest(filename):
+    import json
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename) as f:
+            lines = f.read().splitlines()
+    jobs = []
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        if 'template' not in job or 'output' not in job:
+            raise ValueError(
+                'Job without "template" or "output" at line %i of %s'
+                % (number + 1, filename))
+        jobs.append(job)
+    return jobs
+
+
+def _fill_batch(jobs, vars, use_html, encoding, workers=1, sandbox=None):
+    """
+    Render batch jobs, in worker processes if workers > 1.  All jobs of
+    one template go to the same worker so it is parsed only once.
+    """
+    if workers <= 1 or len(jobs) < 2:
+        return _fill_jobs(jobs, vars, use_html, encoding, sandbox)
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job['template'], []).append(job)
+    buckets = [[] for i in range(workers)]
+    for name in sorted(groups, key=lambda name: -len(groups[name])):
+        min(buckets, key=len).extend(groups[name])
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_fill_jobs, bucket, vars, use_html,
+                                   encoding, sandbox)
+                   for bucket in buckets if bucket]
+        return sum(future.result() for future in futures)
+
+
+def _fill_jobs(jobs, vars, use_html, encoding, sandbox=None):
+    loaders = {}
+    for job in jobs:
+        _fill_job(job, vars, use_html, encoding, loaders, sandbox=sandbox)
+    return len(jobs)
+
+
+def _fill_job(job, vars, use_html, encoding, loaders, used=None,
+              sandbox=None):
+    """
+    Render one batch job.  The paths of all files it reads are added to
+    used (a set) if given.
+    """
+    import json
+    if job.get('html', use_html):
+        TemplateClass = HTMLTemplate
+    else:
+        TemplateClass = Template
+    loader = loaders.get(TemplateClass)
+    if loader is None:
+        loader = loaders[TemplateClass] = TemplateLoader(
+            os.curdir, template_class=TemplateClass, encoding=encoding,
+            sandbox=sandbox)
+    ns = dict(vars)
+    data = job.get('data') or []
+    if isinstance(data, basestring_):
+        data = [data]
+    for filename in data:
+        if used is not None:
+            used.add(os.path.normpath(filename))
+        with open(filename) as f:
+            ns.update(json.load(f))
+    ns.update(job.get('vars') or {})
+    loader.track = used
+    try:
+        result = loader.load_path(job['template']).substitute(ns)
+    finally:
+        loader.track = None
+    _write_output(job['output'], result, encoding)
+
+
+class FillWatcher(object):
+    """
+    Render batch jobs and render them again when their inputs change.
+
+    For every output the files read while rendering it are remembered:
+    the template, the templates it inherits from and its data files.
+    ``check()`` polls the modification times of all of them (and of the
+    manifest) and renders only the outputs depending on changed files;
+    parsed templates stay cached in between.
+    """
+
+    def __init__(self, manifest, vars, use_html=False, encoding='utf8',
+                 sandbox=None):
+        self.manifest = manifest
+        self.vars = vars
+        self.use_html = use_html
+        self.encoding = encoding
+        self.sandbox = sandbox
+        self.loaders = {}
+        self.jobs = {}
+        self.dependencies = {}
+        self.mtimes = {}
+        if manifest is not None:
+            self.jobs = self.read_jobs()
+
+    def read_jobs(self):
+        return dict((job['output'], job)
+                    for job in _read_manifest(self.manifest))
+
+    def mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def render(self, outputs):
+        """
+        Render the jobs of outputs, an error is reported and the output
+        is rendered again when one of its files changes.
+        """
+        rendered = []
+        for output in sorted(outputs):
+            job = self.jobs[output]
+            used = set([os.path.normpath(job['template'])])
+            try:
+                _fill_job(job, self.vars, self.use_html, self.encoding,
+                          self.loaders, used, self.sandbox)
+            except Exception as e:
+                sys.stderr.write('Error rendering %s: %s\n' % (output, e))
+            else:
+                rendered.append(output)
+            self.dependencies[output] = used
+            for filename in used:
+                if filename not in self.mtimes:
+                    self.mtimes[filename] = self.mtime(filename)
+        return rendered
+
+    def check(self):
+        """
+        Render the outputs whose inputs changed since the last check and
+        return their names.
+        """
+        changed = set()
+        for filename, mtime in list(self.mtimes.items()):
+            current = self.mtime(filename)
+            if current != mtime:
+                self.mtimes[filename] = current
+                changed.add(filename)
+                for loader in self.loaders.values():
+                    loader.invalidate(filename)
+        outputs = set(output for output, used in self.dependencies.items()
+                      if used & changed)
+        if self.manifest is not None and self.manifest in changed:
+            jobs = self.read_jobs()
+            outputs.update(output for output, job in jobs.items()
+                           if self.jobs.get(output) != job)
+            for output in set(self.jobs) - set(jobs):
+                self.dependencies.pop(output, None)
+            outputs &= set(jobs)
+            self.jobs = jobs
+        return self.render(outputs)
+
+    def run(self, interval=1.0):
+        import time
+        if self.manifest is not None:
+            self.mtimes[self.manifest] = self.mtime(self.manifest)
+        self.render(self.jobs)
+        while True:
+            time.sleep(interval)
+            for output in self.check():
+                sys.stderr.write('Rendered %s\n' % output)
+
+
+def _write_output(filename, result, encoding):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if isinstance(result, unicode):
+        result = result.encode(encoding)
+    with open(filename, 'wb') as f:
+        f.write(result)
+
+
+_compile_command_usage = """\
+%prog compile [OPTIONS] DIRECTORY OUTPUT
+
+Compile the templates below DIRECTORY into the Python package OUTPUT,
+with one module per template.  Render them with
+package.render(template_name, **ns), the name relative to DIRECTORY,
+or the render(**ns) function of a template module.
+"""
+
+
+def compile_command(args=None):
+    import optparse
+    if args is None:
+        args = sys.argv[1:]
+    parser = optparse.OptionParser(
+        version=__version__,
+        usage=_compile_command_usage)
+    parser.add_option(
+        '--html',
+        dest='use_html',
+        action='store_true',
+        help="Compile HTML templates (with automatic HTML quoting)")
+    parser.add_option(
+        '--encoding',
+        dest='encoding',
+        default='utf8',
+        help="Encoding of the templates (default utf8)")
+    parser.add_option(
+        '--pattern',
+        dest='pattern',
+        default='*',
+        help="Shell pattern of the template file names (default *)")
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        print('You must give a template directory and an output directory')
+        sys.exit(2)
+    if options.use_html:
+        TemplateClass = HTMLTemplate
+    else:
+        TemplateClass = Template
+    modules = compile_directory(args[0], args[1], options.pattern,
+                                TemplateClass, options.encoding)
+    sys.stderr.write('Compiled %i templates into %s\n'
+                     % (len(modules), args[1]))
+
+
 if __name__ == '__main__':
-    fill_command()
+    if sys.argv[1:2] == ['compile']:
+        compile_command(sys.argv[2:])
+    else:
+        fill_command()
@@ -13,3 +13,32 @@ def test_looper():
         elif item == 'orange':
             assert loop.last
         assert result[loop.number-1] == (loop.number, item)
+
+
+def test_looper_groupby():
+    class Row(object):
+        def __init__(self, cat):
+            self.cat = cat
+
+        def category(self):
+            return self.cat
+    rows = [Row(c) for c in 'aabccc']
+    expected = [(True, False), (False, True), (True, True),
+                (True, False), (False, False), (False, True)]
+    for getter in ['.cat', '.category()', lambda row: row.cat]:
+        grouped = [(loop.first_group(), loop.last_group())
+                   for loop, row in looper(rows).groupby(getter)]
+        assert grouped == expected
+        plain = [(loop.first_group(getter), loop.last_group(getter))
+                 for loop, row in looper(rows)]
+        assert plain == expected
+    seq = [{'k': 1}, {'k': 1}, {'k': 2}]
+    assert [loop.first_group() for loop, item in looper(seq).groupby('k')
+            ] == [True, False, True]
+    assert [loop.first_group('k') for loop, item in looper(seq)
+            ] == [True, False, True]
+    assert list(looper([]).groupby('k')) == []
+    t = Template('{{for loop, x in looper(xs).groupby()}}'
+                 '{{if loop.first_group()}}[{{endif}}{{x}}'
+                 '{{if loop.last_group()}}]{{endif}}{{endfor}}')
+    assert t.substitute(xs='aab') == '[aa][b]'
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from pytest import raises
+import os
+import subprocess
+import sys
+
+from pytest import raises, importorskip, skip
 from tempita_lite import *
 
 
@@ -136,3 +140,684 @@ def test_whitespace():
     b
   </div>
 """
+
+def test_required_names():
+    t = Template('{{default title="x"}}{{title}} {{for i in items}}'
+                 '{{i.name|upper}}{{len(items)}}{{endfor}}{{footer}}',
+                 namespace={'upper': str.upper})
+    assert t.required_names == frozenset(['items', 'footer'])
+    assert t.bound_names == frozenset(['title', 'i'])
+    assert t.missing_names({'items': []}) == ['footer']
+
+def test_strict():
+    t = Template('{{if x}}{{y}}{{endif}}', strict=True)
+    with raises(NameError) as excinfo:
+        t.substitute(x=0)
+    assert 'Missing template variables: y' in str(excinfo.value)
+    assert t.substitute(x=0, y=1) == ''
+    t = Template('{{def row}}{{x}}{{y}}{{enddef}}{{for x in xs}}{{row()}}'
+                 '{{endfor}}', strict=True)
+    assert t.required_names == frozenset(['xs', 'y'])
+    assert t.required_names is t.required_names
+    assert t.substitute(xs=[1, 2], y='') == '12'
+
+def test_compiled():
+    t = Template('{{default sep=","}}{{for a, b in sorted(z.items())}}'
+                 '{{if not a}}{{continue}}{{endif}}{{a}}={{b|repr}}{{sep}}'
+                 '{{endfor}}{{def total}}{{sum(z.values())}}{{enddef}}'
+                 '{{total}}')
+    interpreted = t.substitute(z={0: 1, 1: 5, 2: 3}, sep=';')
+    assert t._render_func is not None
+    compiled = t.substitute(z={0: 1, 1: 5, 2: 3}, sep=';')
+    assert t._render_func
+    assert compiled == interpreted == '1=5;2=3;9'
+    t = Template('{{[i for i in y if i > z]}} {{(lambda: z)()}}')
+    for i in range(3):
+        assert t.substitute(y=[1, 3], z=2) == '[3] 2'
+
+    class Upper(Template):
+        def _repr(self, value, pos):
+            return Template._repr(self, value, pos).upper()
+    t = Upper('{{x}}')
+    compiles = []
+    t._compile = lambda: compiles.append(1) or Template._compile(t)
+    for i in range(3):
+        assert t.substitute(x='a') == 'A'
+    assert t._render_func is False
+    assert compiles == [1]
+    t = Upper('{{for r in rows}}{{r}}{{endfor}}')
+    for i in range(3):
+        assert t.substitute(rows=['a', 'b']) == 'AB'
+    assert Upper('{{x}}{{x | safe}}').substitute(x='a') == 'Aa'
+
+def test_compiled_errors():
+    t = Template('a\n{{if x}}{{y}}{{endif}}', name='err.txt')
+    for i in range(2):
+        with raises(NameError) as excinfo:
+            t.substitute(x=1)
+        assert str(excinfo.value) == (
+            "name 'y' is not defined at line 2 column 11 in file err.txt")
+    assert t._render_func
+
+def test_column_loop():
+    class Row(object):
+        def __init__(self, a, b):
+            self.a, self.b = a, b
+    rows = [Row(1, '<x>'), Row(None, 'y'), Row(2.5, u'z')]
+    for cls, expected in [(Template, '1:<x>;:y;2.5:z;'),
+                          (HTMLTemplate, '1:&lt;x&gt;;:y;2.5:z;')]:
+        t = cls('{{for r in rows}}{{r.a}}:{{r.b}};{{endfor}}{{r.a}}')
+        assert t._column_spec(t._parsed[0])
+        for i in range(2):
+            assert t.substitute(rows=iter(rows)) == expected + '2.5'
+    t = Template('{{for r in rows}}{{r["a"]}}{{endfor}}', name='t.txt')
+    for i in range(2):
+        with raises(KeyError) as excinfo:
+            t.substitute(rows=[{'a': 1}, {}])
+        assert 'at line 1 column 20 in file t.txt' in str(excinfo.value)
+
+def test_column_loop_numpy():
+    numpy = importorskip('numpy')
+    rows = numpy.array([(1, 2.5), (2, 3.0)], dtype=[('a', 'i4'), ('b', 'f8')])
+    t = Template('{{for r in rows}}{{r["a"]}}={{r["b"]}} {{endfor}}')
+    assert t.substitute(rows=rows) == '1=2.5 2=3.0 '
+
+def test_parse_nodes():
+    import pickle
+    from tempita_lite import parse, ForNode, CondNode
+    tree = parse('{{for x in y}}{{if x}}{{x}}{{else}}-{{endif}}{{endfor}}')
+    node = tree[0]
+    assert isinstance(node, ForNode)
+    assert (node.kind, node.pos, node.vars, node.expr) == (
+        'for', (1, 3), ('x',), 'y')
+    assert isinstance(node.content[0], CondNode)
+    assert node.content[0].parts[1].kind == 'else'
+    expected = ('for', (1, 3), ('x',), 'y', [
+        ('cond', (1, 17),
+         ('if', (1, 17), 'x', [('expr', (1, 25), 'x')]),
+         ('else', (1, 30), None, ['-']))])
+    assert node == expected
+    assert type(node.to_tuple()[4][0]) is tuple
+    assert node.to_tuple() == expected
+    assert pickle.loads(pickle.dumps(tree)) == tree
+    assert type(pickle.loads(pickle.dumps(tree))[0]) is ForNode
+
+def test_render_metrics(tmpdir):
+    tmpdir.join('base.txt').write('<{{self.body}}>')
+    tmpdir.join('page.txt').write('{{inherit "base.txt"}}{{1 / x}}')
+    metrics = RenderMetrics()
+    loader = TemplateLoader(str(tmpdir), metrics=metrics)
+    page = str(tmpdir.join('page.txt'))
+    for i in range(3):
+        assert loader.load('page.txt').substitute(x=2) == '<0.5>'
+    with raises(ZeroDivisionError):
+        loader.load('page.txt').substitute(x=0)
+    stats = metrics.stats()
+    assert stats[page]['count'] == 4
+    assert stats[page]['errors'] == 1
+    assert stats[page]['size'] == 15
+    assert stats[str(tmpdir.join('base.txt'))]['count'] == 3
+    assert metrics.stats('inherit')[page]['count'] == 3
+    assert metrics.stats('compile')[page]['count'] == 1
+    assert metrics.stats('parse')[page]['count'] == 1
+    assert metrics.stats('cache_miss')[page]['count'] == 1
+    assert metrics.stats('cache_hit')[page]['count'] == 3
+    assert [name for name, seconds in metrics.slowest(1)] in (
+        [page], [str(tmpdir.join('base.txt'))])
+
+def test_sandbox():
+    sandbox = Sandbox()
+    t = Template('{{def row}}!{{enddef}}'
+                 '{{for x in items}}{{if x in (1, 2) and not x > 5}}'
+                 '{{x * 2}}{{else}}-{{endif}}{{endfor}} {{len(items)}} '
+                 '{{d["a"][1:]}} {{3 if d else 4}} {{row()}}',
+                 sandbox=sandbox)
+    for i in range(2):
+        assert t.substitute(items=[1, 2, 3], d={'a': 'xyz'}) == (
+            '24- 3 yz 3 !')
+    for expr in ['x.__class__', '[a for a in b]', '2 ** 100',
+                 '"{0}".format(x)', 'x | y.upper', 'lambda: 1', 'f(*x)']:
+        with raises(TemplateError):
+            Template('{{%s}}' % expr, sandbox=sandbox)
+    t = Template('{{__import__("os")}}', sandbox=sandbox)
+    with raises(NameError):
+        t.substitute()
+    t = Template('{{f()}}', sandbox=sandbox)
+    with raises(TypeError):
+        t.substitute(f=lambda: 1)
+    t = Template('{{f(x)}}', sandbox=Sandbox({'f': abs}))
+    assert t.substitute(x=-1) == '1'
+    t = HTMLTemplate('{{x}}{{x | html}}', sandbox=sandbox)
+    assert t.substitute(x='<') == '&lt;<'
+    assert sandbox.evaluate('[1] + [x]', {'x': 2}) == [1, 2]
+
+def test_sandbox_frames():
+    rows = (row for row in [1])
+    for expr in ['rows.gi_frame.f_globals', 'rows.gi_frame.f_builtins',
+                 'rows.gi_code', 'f.func_globals']:
+        with raises(TemplateError):
+            Template('{{%s}}' % expr, sandbox=Sandbox())
+    frame = sys._getframe()
+    t = Template('{{frame.clear}}', sandbox=Sandbox())
+    with raises(ValueError):
+        t.substitute(frame=frame)
+    t = Template('{{for row in rows}}{{row}}{{endfor}}', sandbox=Sandbox())
+    assert t.substitute(rows=rows) == '1'
+
+def test_sandbox_names_and_sizes():
+    sandbox = Sandbox()
+    t = Template('{{start_braces}}x{{end_braces}} {{y}}', sandbox=sandbox,
+                 namespace={'y': 1})
+    assert t.substitute() == '{{x}} 1'
+    t = Template('{{s * n}}|{{len(range(n))}}', sandbox=sandbox)
+    assert t.substitute(s='ab', n=2) == 'abab|2'
+    for ns in [{'s': 'x', 'n': 4000000000}, {'s': [1], 'n': 10 ** 7},
+               {'s': 3, 'n': 4000000000}]:
+        with raises(ValueError):
+            t.substitute(ns)
+    t = Template('{{default b = a + a}}{{default c = b + b}}{{len(c)}}',
+                 sandbox=sandbox)
+    assert t.substitute(a='x') == '4'
+    with raises(ValueError):
+        t.substitute(a='x' * 300000)
+    t = Template('{{sum(xs)}}', sandbox=sandbox)
+    assert t.substitute(xs=[1, 2.5]) == '3.5'
+    with raises(ValueError):
+        Template('{{len(sum([s] * 1000, []))}}',
+                 sandbox=sandbox).substitute(s=[0] * 2000)
+
+def test_render_limits():
+    import io
+    content = ('{{def row}}{{for j in range(n)}}{{j}}{{endfor}}{{enddef}}'
+               '{{for i in range(n)}}\n{{row()}}{{endfor}}')
+    for limits, message, position in [
+            (RenderLimits(output=20), 'Output longer than 20', (2, 3)),
+            (RenderLimits(iterations=30), 'More than 30 loop', (1, 14)),
+            (RenderLimits(seconds=0), 'Render took longer', (1, 60))]:
+        t = Template(content, limits=limits)
+        for i in range(3):
+            if limits.seconds is None:
+                assert t.substitute(n=3) == '\n012\n012\n012'
+            with raises(TemplateLimitError) as e:
+                t.substitute(n=10)
+            assert message in str(e.value)
+            assert e.value.position == position
+        with raises(TemplateLimitError) as e:
+            t.render_to(io.StringIO(), n=10)
+        assert e.value.position == position
+    import itertools
+    t = Template('{{for r in rows}}<td>{{r}}</td>{{endfor}}',
+                 limits=RenderLimits(iterations=5))
+    assert not t._column_spec(t._parsed[0])
+    for i in range(3):
+        with raises(TemplateLimitError):
+            t.substitute(rows=itertools.count())
+
+def test_static_escaping():
+    class Obj(object):
+        index = 'x'
+        number = '<'
+    t = HTMLTemplate('{{for loop, x in looper(items)}}<i {{attr(class_=x)}}>'
+                     '{{loop.number}} {{x}} {{"<b>"}} {{x | safe}} '
+                     '{{html(x)}} {{len(x)}} {{n.index}}</i>{{endfor}}')
+    expected = ('<i class="a&lt;">1 a&lt; &lt;b&gt; a< a< 2 x</i>'
+                '<i class="&amp;">2 &amp; &lt;b&gt; & & 1 x</i>')
+    for i in range(3):
+        assert t.substitute(items=['a<', '&'], n=Obj()) == expected
+    t = HTMLTemplate('{{x | str.upper | safe}}{{loop.number}}')
+    for i in range(2):
+        assert t.substitute(x='<a>', loop=Obj()) == '<A>&lt;'
+    t = Template('{{x | safe}}{{"<"}}')
+    for i in range(2):
+        assert t.substitute(x='<') == '<<'
+
+def test_minify_html():
+    content = ('<ul>\n  {{for x in items}}\n    <li>  {{x}}  </li>\n'
+               '  {{endfor}}\n</ul>\n<pre>\n  a   b\n</pre>\n'
+               '<TEXTAREA rows="2">  {{x}}  </textarea>  \xa0\n\n'
+               '<script>  var a;  </script>')
+    t = HTMLTemplate(content, minify=True)
+    expected = ('<ul>\n <li> 1 </li>\n <li> 2 </li>\n</ul>\n'
+                '<pre>\n  a   b\n</pre>\n<TEXTAREA rows="2">  2  </textarea>'
+                ' \xa0\n<script>  var a;  </script>')
+    for i in range(3):
+        assert t.substitute(items=[1, 2]) == expected
+    assert HTMLTemplate(content).substitute(items=[1, 2]) != expected
+    t = HTMLTemplate('<a  title="a    {{x}}  b"\n  class=\'c  d\'>don\'t   '
+                     '<b>  x</b></a>', minify=True)
+    assert t.substitute(x='<') == (
+        '<a title="a    &lt;  b"\nclass=\'c  d\'>don\'t <b> x</b></a>')
+
+def test_error_positions():
+    t = Template('a\n{{def row}}\n {{y}}{{enddef}}'
+                 '{{for x in [1]}}{{row()}}{{endfor}}', name='t.txt')
+    t.use_compiled = False
+    for i in range(2):
+        with raises(NameError) as e:
+            t.substitute()
+        assert str(e.value) == (
+            "name 'y' is not defined at line 3 column 4 in file t.txt"
+            " at line 3 column 35 in file t.txt")
+    with raises(SyntaxError) as e:
+        Template('{{x +}}').substitute()
+    assert 'invalid syntax in expression: x +' in str(e.value)
+
+def test_template_cache(capsys):
+    from tempita_lite import template_cache
+    template_cache.clear()
+    for i in range(3):
+        assert sub('{{x}}!', x=i) == '%i!' % i
+        assert sub_html('{{x}}', x='<') == '&lt;'
+    assert sub('<<x>>', delimeters=('<<', '>>'), x=1) == '1'
+    assert capsys.readouterr().out == ''
+    stats = template_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (4, 3, 3)
+    cache = TemplateCache(maxsize=2)
+    first = cache.get(Template, 'a')
+    cache.get(Template, 'b')
+    assert cache.get(Template, 'a') is first
+    cache.get(Template, 'c')
+    assert cache.stats()['evictions'] == 1
+    assert cache.get(Template, 'a') is first
+    assert cache.stats()['misses'] == 3
+    template_cache.clear()
+    assert template_cache.stats()['size'] == 0
+
+def test_render_def():
+    t = Template('{{default title = "List"}}{{def item}}*{{enddef}}'
+                 '{{def items}}{{title}}:{{for x in xs}}{{x * 1}}{{item()}}{{endfor}}'
+                 '{{enddef}}page {{1 / 0}}', name='page')
+    assert t.render_def('items', xs=[1, 2]) == 'List:1*2*'
+    assert t.render_def('items', {'xs': [], 'title': 'T'}) == 'T:'
+    with raises(TemplateError):
+        t.render_def('nothing', xs=[])
+    with raises(TypeError) as e:
+        t.render_def('items', xs=[None])
+    assert str(e.value).endswith('at line 1 column 90 in file page')
+    t = Template('{{def a}}{{x}}{{enddef}}{{y}}', strict=True)
+    with raises(NameError) as e:
+        t.render_def('a')
+    assert 'Missing template variables: x' in str(e.value)
+    assert t.render_def('a', x=1) == '1'
+
+def test_lazy_values():
+    calls = []
+
+    def load():
+        calls.append(1)
+        return 'bob'
+    t = Template('{{if show}}{{user}}{{def greet}}hi {{user}}{{enddef}}'
+                 '{{greet()}} {{user.upper()}}{{endif}}.')
+    for i in range(3):
+        assert t.substitute(show=False, user=lazy(load)) == '.'
+    assert calls == []
+    for i in range(3):
+        assert t.substitute(show=True, user=lazy(load)) == 'bobhi bob BOB.'
+    assert len(calls) == 3
+    templates = {'base': Template('{{self.body}}|{{user}}', name='base')}
+    t = Template('{{inherit "base"}}{{user}}', name='page',
+                 get_template=lambda name, from_template: templates[name])
+    assert t.substitute(user=lazy(load)) == 'bob|bob'
+    assert len(calls) == 4
+    t = Template('{{user}}', sandbox=Sandbox())
+    assert t.substitute(user=lazy(load)) == 'bob'
+
+def test_specialize():
+    site = {'beta': False, 'links': ['a', 'b'], 'title': 'Site'}
+    t = HTMLTemplate(
+        '<h1>{{site["title"]}}</h1>{{if site["beta"]}}beta{{endif}}'
+        '{{for link in site["links"]}}<a>{{link.upper()}}</a>{{endfor}}'
+        '{{for x in site["links"]}}{{x}}{{user}}{{x + user}}{{endfor}}'
+        '{{if user}}{{user}}{{elif site["title"]}}anonymous{{endif}}'
+        '{{# comment}}{{default n = 1}}{{n}}')
+    s = t.specialize(site=site)
+    assert s._parsed[0] == '<h1>Site</h1><a>A</a><a>B</a>'
+    assert s._parsed[1][0] == 'for'
+    assert [part[0] for part in s._parsed[2][2:]] == ['if', 'else']
+    for user in ['', '<u>']:
+        for i in range(3):
+            assert s.substitute(user=user, n=2) == t.substitute(
+                site=site, user=user, n=2)
+    assert t.specialize(site=site, user='x', n=3).substitute() == (
+        t.substitute(site=site, user='x', n=3))
+    assert t.specialize(site=site, user='x', n=3)._parsed == [
+        '<h1>Site</h1><a>A</a><a>B</a>axaxbxbxx3']
+    t = Template('{{def row}}{{x}}{{enddef}}{{for x in xs}}{{row()}}'
+                 '{{endfor}}{{x}}{{1 / zero}}')
+    s = t.specialize(xs=[1, 2], zero=0)
+    with raises(ZeroDivisionError):
+        s.substitute()
+    assert t.specialize(xs=[1, 2], zero=1).substitute() == '1221.0'
+    t = Template('{{for c in cols}}{{for r in rows}}{{r}}{{c}};{{endfor}}'
+                 '{{endfor}}').specialize(cols=['a', 'b'])
+    for i in range(3):
+        assert t.substitute(rows=[1, 2]) == '1a;2a;1b;2b;'
+    t = Template('{{site}} {{id}} {{type}} {{len(xs)}}')
+    s = t.specialize(site='S', xs=[1])
+    assert s.substitute(id=5, type='t', len=lambda xs: 'n') == 'S 5 t n'
+    assert t.specialize(xs=[1], len=len)._parsed[-1] == ' 1'
+
+def test_flush(tmpdir):
+    import gc
+    import io
+    t = Template('<head>\n{{flush}}\n{{for x in xs}}{{x}}'
+                 '{{if x > 1}}{{flush}}{{endif}}{{endfor}}'
+                 '{{def d}}d{{flush}}{{enddef}}{{d()}}</body>')
+    assert list(t.stream(xs=[1, 2, 3])) == ['<head>\n', '12', '3',
+                                         'd</body>']
+    for i in range(3):
+        assert t.substitute(xs=[1, 2, 3]) == '<head>\n123d</body>'
+    assert t.specialize(xs=[1, 2]).substitute() == '<head>\n12d</body>'
+
+    class Output(io.StringIO):
+        def flush(self):
+            flushed.append(self.getvalue())
+    flushed = []
+    t.render_to(Output(), xs=[1, 2])
+    assert flushed == ['<head>\n', '<head>\n12']
+    with raises(ZeroDivisionError) as e:
+        list(Template('a{{flush}}{{for x in xs}}{{1 / x}}{{flush}}'
+                      '{{endfor}}', name='t').stream(xs=[1, 0]))
+    assert str(e.value).endswith('line 1 column 28 in file t')
+    templates = {'base': Template('<h>{{flush}}{{self.body}}', name='base')}
+    t = Template('{{inherit "base"}}body', name='page',
+                 get_template=lambda name, from_template: templates[name])
+    assert list(t.stream()) == ['<h>', 'body']
+    t = Template('a\n{{for x in xs}}{{x}}{{flush}}{{endfor}}',
+                 limits=RenderLimits(iterations=2))
+    for render in [t.substitute, lambda **ns: list(t.stream(**ns))]:
+        with raises(TemplateLimitError) as e:
+            render(xs=range(5))
+        assert e.value.position == (2, 3)
+    tmpdir.join('page.html').write(
+        'a\n{{flush}}{{for x in xs}}b{{x}}{{flush}}{{endfor}}c')
+    loader = TemplateLoader(str(tmpdir))
+    for t in [Template.from_filename(str(tmpdir.join('page.html')),
+                                     mapped=True), loader.load('page.html')]:
+        assert list(t.stream(xs=[1, 2])) == ['a\n', 'b1', 'b2', 'c']
+    loader.freeze(compact=True)
+    if hasattr(gc, 'unfreeze'):
+        gc.unfreeze()
+    assert list(t.stream(xs=[1, 2])) == ['a\n', 'b1', 'b2', 'c']
+
+def test_allocation_profiler():
+    profiler = AllocationProfiler()
+    t = Template('{{def row}}{{x}}{{enddef}}{{for x in xs}}'
+                 '{{str(x) * 1000}}{{row()}}{{endfor}}', name='page',
+                 profiler=profiler)
+    for i in range(3):
+        assert len(t.substitute(xs=range(10))) == 10010
+    stats = profiler.stats()
+    assert stats['page']['renders'] == 3
+    assert stats['page']['peak'] >= 10000
+    sites = dict((site, size) for site, size, count in profiler.top(100))
+    # two compiled renders
+    assert sites[('page', (1, 44))] >= 20000
+    assert ('page', None) in sites
+    profiler.clear()
+    assert profiler.stats() == {}
+
+def test_mapped_template(tmpdir):
+    import io
+    path = tmpdir.join('big.txt')
+    path.write_binary(u'Header\n{{for x in items}}\n  item {{x}} \xe9\n'
+                      u'{{endfor}}\ntail\n'.encode('utf8'))
+    expected = u'Header\n  item 1 \xe9\n  item 2 \xe9\ntail\n'
+    t = Template.from_filename(str(path), encoding='utf8', mapped=True)
+    for i in range(3):
+        assert t.substitute(items=[1, 2]) == expected
+    out = io.BytesIO()
+    t.render_to(out, items=[1, 2])
+    assert out.getvalue() == expected.encode('utf8')
+    out = io.StringIO()
+    t.render_to(out, items=[1, 2])
+    assert out.getvalue() == expected
+    path.write_binary(b'a\n{{1/0}}')
+    t = Template.from_filename(str(path), mapped=True)
+    with raises(ZeroDivisionError) as e:
+        t.substitute()
+    assert 'line 2 column 3' in str(e.value)
+    for content in [u'\xe9\xe9\xe9\xe9{{1/0}}', u'\xe9\n\xe9\xe9{{x}}{{1/0}}']:
+        path.write_binary(content.encode('utf8'))
+        errors = []
+        for mapped in (False, True):
+            metrics = RenderMetrics()
+            t = Template.from_filename(str(path), encoding='utf8',
+                                       mapped=mapped, metrics=metrics)
+            assert metrics.stats('parse')[str(path)]['count'] == 1
+            with raises(ZeroDivisionError) as e:
+                t.substitute(x=1)
+            errors.append(str(e.value))
+        assert errors[0] == errors[1]
+    assert errors[1].endswith('line 2 column 10 in file %s' % path)
+    path.write_binary(b'{{y}}' + b'x' * 2000)
+    t = Template.from_filename(str(path), encoding='utf8', mapped=True,
+                               limits=RenderLimits(output=10))
+    for out in [io.BytesIO(), io.StringIO()]:
+        with raises(TemplateLimitError):
+            t.render_to(out, y=1)
+        assert len(out.getvalue()) <= 10
+    path.write_binary(b'')
+    assert Template.from_filename(str(path), mapped=True).substitute() == ''
+
+def test_precompile_directory(tmpdir):
+    tmpdir.join('base.txt').write('[{{self.body}}]')
+    tmpdir.mkdir('pages').join('page.txt').write(
+        '{{inherit "../base.txt"}}{{for i in range(n)}}{{i}}{{endfor}}')
+    tmpdir.join('.hidden.txt').write('{{')
+    for workers in (1, 2):
+        loader = precompile_directory(str(tmpdir), workers=workers,
+                                      pattern='*.txt')
+        assert len(loader.templates) == 2
+        page = loader.load('pages/page.txt')
+        assert page._render_func
+        assert page.substitute(n=3) == '[012]'
+        assert loader.load('base.txt') is loader.templates[
+            str(tmpdir.join('base.txt'))]
+
+def test_compile_directory(tmpdir, monkeypatch):
+    source = tmpdir.mkdir('templates')
+    source.join('base.html').write(
+        '<title>{{self.title()}}</title>{{self.body | safe}}')
+    source.mkdir('pages').join('page.html').write(
+        '{{inherit "../base.html"}}{{def title}}T{{enddef}}'
+        '{{for x in xs}}<i>{{x}}</i>{{endfor}}{{1 / len(xs)}}')
+    source.join('bad.html').write('{{if x}}{{1 +}}{{endif}}')
+    source.join('early.html').write('{{a.nope}}\n{{b}}')
+    modules = compile_directory(str(source), str(tmpdir.join('tmpl_pkg')),
+                                template_class=HTMLTemplate)
+    assert modules == {'base.html': 'base_html', 'bad.html': 'bad_html',
+                       'early.html': 'early_html',
+                       'pages/page.html': 'pages_page_html'}
+    expected = TemplateLoader(str(source), HTMLTemplate).load(
+        'pages/page.html').substitute(xs=['<', 'b'])
+    monkeypatch.syspath_prepend(str(tmpdir))
+
+    def fail(*args, **kw):
+        raise AssertionError('template parsed')
+    monkeypatch.setattr('tempita_lite.parse', fail)
+    import tmpl_pkg
+    from tmpl_pkg import pages_page_html
+    assert pages_page_html.template._render_func
+    assert pages_page_html.render(xs=['<', 'b']) == expected
+    assert tmpl_pkg.render('pages/page.html', xs=['<', 'b']) == expected
+    with raises(ZeroDivisionError) as e:
+        tmpl_pkg.render('pages/page.html', xs=[])
+    assert 'line 1 column 90 in file pages/page.html' in str(e.value)
+    with raises(AttributeError) as e:
+        tmpl_pkg.render('early.html', a=1, b=2)
+    assert 'line 1 column 3 in file early.html' in str(e.value)
+    assert tmpl_pkg.render('bad.html', x=False) == ''
+    with raises(SyntaxError):
+        tmpl_pkg.render('bad.html', x=True)
+    for name in list(sys.modules):
+        if name.startswith('tmpl_pkg'):
+            del sys.modules[name]
+
+def test_lean_loader(tmpdir):
+    header = '<html><head><title>Shared</title></head>\n'
+    tmpdir.join('a.html').write(header + '{{for x in xs}}a{{x}}{{endfor}}')
+    tmpdir.join('b.html').write(header + '{{if x}}b{{endif}}')
+    loader = TemplateLoader(str(tmpdir), share_literals=True,
+                            keep_source=False)
+    a, b = loader.load('a.html'), loader.load('b.html')
+    assert a._parsed[0] is b._parsed[0]
+    assert a._content is None
+    assert a.content == header + '{{for x in xs}}a{{x}}{{endfor}}'
+    for i in range(3):
+        assert a.substitute(xs=[1]) == header + 'a1'
+        assert b.substitute(x=1) == header + 'b'
+    assert header in a._render_func.__code__.co_consts
+    assert [const for const in a._render_func.__code__.co_consts
+            if const == header][0] is b._parsed[0]
+    assert Template('{{x}}', keep_source=False).content is None
+
+def test_loader_preload_freeze(tmpdir):
+    import gc
+    tmpdir.join('a.html').write('<p>{{for x in xs}}{{x}}{{endfor}}</p>')
+    tmpdir.join('b.html').write('<p>{{inherit "a.html"}}</p>')
+    loader = TemplateLoader(str(tmpdir))
+    assert loader.preload() == 2
+    a = loader.load('a.html')
+    assert a._render_func
+    loader.freeze(compact=True)
+    if hasattr(gc, 'unfreeze'):
+        gc.unfreeze()
+    assert a._parsed[0].buffer is loader.load('b.html')._parsed[0].buffer
+    assert a._render_func
+    assert a.substitute(xs=[1, 2]) == '<p>12</p>'
+
+_uss_script = '''
+import gc, os, sys
+from tempita_lite import TemplateLoader
+
+def uss():
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean', 'Private_Dirty')):
+                total += int(line.split()[1])
+    return total
+
+def child_uss(loader):
+    # unique set size the child adds by rendering every template
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        before = uss()
+        for template in list(loader.templates.values()):
+            template.substitute(xs=[1, 2])
+        gc.collect()
+        os.write(write, str(uss() - before).encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return int(os.read(read, 100))
+
+loader = TemplateLoader(sys.argv[1])
+loader.preload()
+shared = child_uss(loader)
+loader.freeze()
+print(shared, child_uss(loader))
+'''
+
+def test_forked_uss(tmpdir):
+    import gc
+    if (not hasattr(os, 'fork') or not hasattr(gc, 'freeze')
+            or not os.path.exists('/proc/self/smaps_rollup')):
+        skip('needs fork, gc.freeze and /proc/self/smaps_rollup')
+    for i in range(100):
+        tmpdir.join('t%i.html' % i).write(
+            '<p>%i%s</p>{{for x in xs}}<li>{{x}}</li>{{endfor}}<f>%s</f>'
+            % (i, 'x' * 8000, 'y' * 8000))
+    output = subprocess.check_output(
+        [sys.executable, '-c', _uss_script, str(tmpdir)],
+        universal_newlines=True)
+    before, frozen = map(int, output.split())
+    assert frozen < before
+
+def test_compile_directory_class(tmpdir, monkeypatch):
+    tmpdir.join('my_templates.py').write(
+        'from tempita_lite import Template\n\n'
+        'class MyTemplate(Template):\n'
+        '    default_namespace = dict(Template.default_namespace, x=1)\n')
+    source = tmpdir.mkdir('templates')
+    source.join('page.txt').write('{{x}}')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    from my_templates import MyTemplate
+    compile_directory(str(source), str(tmpdir.join('my_pkg')),
+                      template_class=MyTemplate)
+    import my_pkg
+    assert my_pkg.loader.load('page.txt').__class__ is MyTemplate
+    assert my_pkg.render('page.txt') == '1'
+
+    class Local(Template):
+        pass
+    with raises(ValueError):
+        compile_directory(str(source), str(tmpdir.join('local_pkg')),
+                          template_class=Local)
+    for name in ['my_templates', 'my_pkg', 'my_pkg.page_txt']:
+        sys.modules.pop(name, None)
+
+def test_import_time():
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import tempita_lite'],
+        stderr=subprocess.STDOUT, universal_newlines=True)
+    times = {}
+    for line in output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative, module = line[12:].split('|')
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    assert 'tempita_lite' in times
+    for module in ('cgi', 'tokenize', 'pprint', 'inspect', 'copy', 'ast',
+                   'optparse', 'pkg_resources', 'concurrent.futures'):
+        assert module not in times
+    assert times['tempita_lite'] < 1000000
+
+def test_fill_command_batch(tmpdir, monkeypatch):
+    from tempita_lite import fill_command
+    import json
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('base.txt').write('<p>{{self.body}}</p>')
+    tmpdir.join('page.txt').write('{{inherit "base.txt"}}{{name}}{{n}}')
+    jobs = [{'template': 'page.txt', 'output': 'out/%i.txt' % i,
+             'vars': {'name': '<%i>' % i}} for i in range(3)]
+    tmpdir.join('plain.txt').write('<p>{{name}}</p>')
+    jobs.append({'template': 'plain.txt', 'output': 'out/html.txt',
+                 'vars': {'name': '<x>'}, 'html': True})
+    tmpdir.join('jobs.jsonl').write(
+        '\n'.join(json.dumps(job) for job in jobs))
+    for workers in ('1', '2'):
+        fill_command(['--batch', 'jobs.jsonl', '--jobs', workers,
+                      'py:n=1+1'])
+        assert tmpdir.join('out', '1.txt').read() == '<p><1>2</p>'
+        assert tmpdir.join('out', 'html.txt').read() == '<p>&lt;x&gt;</p>'
+
+def test_fill_watcher(tmpdir, monkeypatch):
+    from tempita_lite import FillWatcher
+    import json
+    import os
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('base.txt').write('[{{self.body}}]')
+    tmpdir.join('a.txt').write('{{inherit "base.txt"}}a{{x}}')
+    tmpdir.join('b.txt').write('b{{x}}')
+    tmpdir.join('data.json').write('{"x": 1}')
+    tmpdir.join('jobs.jsonl').write('\n'.join(json.dumps(job) for job in [
+        {'template': 'a.txt', 'output': 'a.out'},
+        {'template': 'b.txt', 'output': 'b.out', 'data': 'data.json'}]))
+    watcher = FillWatcher('jobs.jsonl', {'x': 0})
+    watcher.mtimes['jobs.jsonl'] = watcher.mtime('jobs.jsonl')
+    assert watcher.render(watcher.jobs) == ['a.out', 'b.out']
+    assert tmpdir.join('a.out').read() == '[a0]'
+    assert watcher.check() == []
+
+    def change(name, content):
+        tmpdir.join(name).write(content)
+        mtime = watcher.mtimes[name] + 10
+        os.utime(name, (mtime, mtime))
+    change('base.txt', '({{self.body}})')
+    assert watcher.check() == ['a.out']
+    assert tmpdir.join('a.out').read() == '(a0)'
+    change('data.json', '{"x": 2}')
+    assert watcher.check() == ['b.out']
+    assert tmpdir.join('b.out').read() == 'b2'